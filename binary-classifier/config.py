@@ -9,9 +9,16 @@ MODELNAME = "alltrans3.0"
 # i recommend 64
 BATCHSIZE = 64
 
+# threads used to read the training data files
+LOAD_THREADS = 1
+
 # general or elementary
 TRANSPOSITION_TYPE = "general"
 
+# how artificial identities are generated
+# can be "exact" (sampled uniformly with no rejection) or "rejection" (random words are filtered)
+IDENTITY_SAMPLER = "exact"
+
 # TRANSFORMER HYPERPARAMETERS
 n_embed = 384
 vocab_size = GROUP_SIZE**2 if TRANSPOSITION_TYPE == "general" else GROUP_SIZE
@@ -20,6 +27,11 @@ n_head = 6
 n_blocks = 1
 dropout = 0
 
+# do all the attention heads at once with a single fused kernel
+# checkpoints are always saved with separate heads, so either setting can load them
+# the outputs differ a tiny bit (around 1e-4) from the separate heads
+FUSED_ATTENTION = False
+
 # TRAINING HYPERPARAMETERS
 # good starting value: 3*10^-5
 learning_rate = 3*(10**-5)
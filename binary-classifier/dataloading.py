@@ -3,6 +3,7 @@ from config import *
 from torch.utils.data import DataLoader, Dataset
 from torch import tensor, float32, cuda, device
 from scipy import sparse
+from concurrent.futures import ThreadPoolExecutor
 import os
 
 class SimpleDataset(Dataset):
@@ -55,24 +56,60 @@ class ExhaustiveDataset(Dataset):
         )
         return sample
 
-# load the data
-print("Loading data...")
+# finds the training data files
+def find_shards():
+  filenames = []
+  curfile = 1
+
+  while os.path.isfile(PATH + DATA + f"train_data{curfile}.csv"):
+    filenames.append(PATH + DATA + f"train_data{curfile}.csv")
+    curfile += 1
+
+  return filenames
+
+# counts the rows of a csv without parsing it
+def count_rows(filename):
+  rows = 0
+  last = b"\n"
+
+  with open(filename, "rb") as file:
+    while chunk := file.read(2**24):
+      rows += chunk.count(b"\n")
+      last = chunk[-1:]
 
-train_data = np.array([[0 for x in range(MAX_LENGTH)]])
+  # the last line might not end in a newline
+  return rows + (last != b"\n")
 
-curfile = 1
-while True:
-  filename = PATH + DATA + f"train_data{curfile}.csv"
+# reads every shard into one preallocated array
+# this avoids concatenating, so peak memory is about the size of the dataset
+def load_shards(filenames, width, threads=LOAD_THREADS):
+  rows = [count_rows(filename) for filename in filenames]
+  offsets = np.cumsum([0] + rows)
 
-  if not os.path.isfile(filename):
-     break
+  output = np.empty((offsets[-1], width), dtype=int)
 
-  data = np.loadtxt(filename, delimiter=",").astype(int)
-  train_data = np.concatenate((train_data, data))
+  def fill(index):
+    data = np.loadtxt(filenames[index], delimiter=",", ndmin=2).astype(int)
 
-  curfile += 1
+    if len(data) != rows[index]:
+      raise Exception(f"Expected {rows[index]} rows in {filenames[index]} but found {len(data)}")
+
+    output[offsets[index]:offsets[index+1]] = data
+
+  if threads > 1:
+    with ThreadPoolExecutor(threads) as pool:
+      # list() makes sure exceptions get raised
+      list(pool.map(fill, range(len(filenames))))
+  else:
+    for index in range(len(filenames)):
+      fill(index)
+
+  return output
+
+# load the data
+print("Loading data...")
 
-train_data = train_data[1:]
+train_data = load_shards(find_shards(), MAX_LENGTH)
 DATASET_SIZE = len(train_data)
 
 val_data = np.loadtxt(PATH + DATA + "val_data.csv", delimiter=",").astype(int)
@@ -91,10 +128,10 @@ X_val = val_data
 X_art_test = art_test_data
 X_true_test = true_test_data
 
-y_train = np.apply_along_axis(is_identity, 1, X_train)
-y_val = np.apply_along_axis(is_identity, 1, X_val)
-y_art_test = np.apply_along_axis(is_identity, 1, X_art_test)
-y_true_test = np.apply_along_axis(is_identity, 1, X_true_test)
+y_train = is_identity_batch(X_train)
+y_val = is_identity_batch(X_val)
+y_art_test = is_identity_batch(X_art_test)
+y_true_test = is_identity_batch(X_true_test)
 
 final_dimension = MAX_LENGTH
 
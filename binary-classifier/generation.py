@@ -2,7 +2,9 @@ from utilities import *
 from config import *
 from tqdm import tqdm
 from multiprocessing import Pool
+from collections import deque
 import numpy as np
+import itertools
 import time
 
 dataset_size = 1000000
@@ -10,53 +12,141 @@ dataset_size = 1000000
 # generates a matrix filled with random integers in [0, GROUP_SIZE-1]
 # we say that 0 denotes the identity element
 # words are uniformly distributed
-def generate_random_sequences(num_seqs, max_length):
-  # we create a new generator every time for parallel processing reasons
-  generator = np.random.default_rng(seed=time.time_ns())
+def generate_random_sequences(num_seqs, max_length, generator=None):
+  if generator is None:
+    generator = np.random.default_rng(seed=time.time_ns())
 
   return generator.integers(0, GROUP_SIZE, size=(num_seqs, max_length))
 
+# an endless supply of independent seeds, one per batch
+# this means no two batches share a random stream, even across processes
+def seed_stream(seed=None):
+  root = np.random.SeedSequence(seed)
+
+  for index in itertools.count():
+    yield np.random.SeedSequence(root.entropy, spawn_key=(index,))
+
 # generates a batch of identities
 # this has nothing to do with pytorch batches
 def make_batch(args):
-  max_length, batch_size = args
+  max_length, batch_size, seed = args
 
   # generate some random sequences
-  new_batch = generate_random_sequences(batch_size, max_length)
+  new_batch = generate_random_sequences(batch_size, max_length, np.random.default_rng(seed))
 
   # keep only the identities
-  return new_batch[np.apply_along_axis(is_identity, 1, new_batch)]
+  return new_batch[is_identity_batch(new_batch)]
+
+class IdentitySampler:
+  """
+    Samples identity words uniformly without any rejection.
+    counts[t][s] is the number of words of length t whose permutation has lehmer rank s.
+    Words are built backwards from the identity, choosing each letter with
+    probability proportional to the number of ways to finish the word.
+  """
+
+  def __init__(self, max_length):
+    self.max_length = max_length
+    states = list(itertools.permutations(range(GROUP_SIZE)))
+
+    # transitions[s, letter] is the rank of permutation s after applying letter
+    # every letter is a transposition, so this is also how you undo it
+    self.transitions = np.empty((len(states), GROUP_SIZE), dtype=int)
+
+    for state in states:
+      for letter in range(GROUP_SIZE):
+        perm = list(state)
+        apply_word(perm, letter)
+        self.transitions[perm_to_rank(state), letter] = perm_to_rank(perm)
+
+    # python ints so the counts are exact however long the words get
+    self.counts = [np.zeros(len(states), dtype=object)]
+    self.counts[0][perm_to_rank(range(GROUP_SIZE))] = 1
+
+    for length in range(max_length):
+      counts = np.zeros(len(states), dtype=object)
+
+      # applying a letter is a bijection, so there are no collisions here
+      for letter in range(GROUP_SIZE):
+        counts[self.transitions[:, letter]] += self.counts[-1]
+
+      self.counts.append(counts)
+
+    # the same thing as probabilities, which is what we need for sampling
+    self.probabilities = [
+      (counts / GROUP_SIZE**length).astype(float) for length, counts in enumerate(self.counts)
+    ]
+
+  def identity_probability(self):
+    # chance that a uniformly random word is an identity
+    return self.counts[-1][perm_to_rank(range(GROUP_SIZE))] / GROUP_SIZE**self.max_length
+
+  def sample(self, amount, generator):
+    identities = np.empty((amount, self.max_length), dtype=int)
+    states = np.full(amount, perm_to_rank(range(GROUP_SIZE)))
+    rows = np.arange(amount)
+
+    for length in range(self.max_length, 0, -1):
+      # where we would have been before the last letter
+      previous = self.transitions[states]
+
+      weights = self.probabilities[length - 1][previous]
+      cumulative = weights.cumsum(axis=1)
+
+      # inverse transform sampling, one letter per row
+      targets = generator.random(amount) * cumulative[:, -1]
+      letters = (cumulative <= targets[:, np.newaxis]).sum(axis=1)
+      letters = np.minimum(letters, GROUP_SIZE - 1)
+
+      identities[:, length - 1] = letters
+      states = previous[rows, letters]
+
+    return identities
 
 # generates identity equivalents
-def generate_identities(amount, max_length, batch_size=None,  workers=2, suppress=False):
-  # default batch_size is amount * 4
+def generate_identities(amount, max_length, batch_size=None, workers=2, suppress=False, seed=None):
+  if IDENTITY_SAMPLER == "exact":
+    return IdentitySampler(max_length).sample(amount, np.random.default_rng(seed))
+
+  # default batch_size is amount
   batch_size = batch_size if batch_size else amount
 
-  # generate the identities
-  identities = np.empty(shape=(1, max_length))
+  # we write straight into the output instead of concatenating
+  identities = np.empty(shape=(amount, max_length), dtype=int)
   generated = 0
 
+  seeds = seed_stream(seed)
+
+  # batches waiting in the pool, oldest first
+  # there's always a couple queued per worker so none of them sit idle,
+  # and they're used in the order they were asked for so a seed always gives the same identities
+  pending = deque()
+
   # go until we've generated enough
-  with tqdm(total=amount, disable=suppress) as pbar:
+  # the pool lives for the whole run so we only pay for starting it once
+  with tqdm(total=amount, disable=suppress) as pbar, Pool(workers) as pool:
     pbar.set_description("Generating identities")
 
     while generated < amount:
-      # do some parallel processing
-      with Pool() as pool:
-        results = pool.map(make_batch, [(max_length, batch_size)]*workers)
+      while len(pending) < 2 * workers:
+        pending.append(pool.apply_async(make_batch, ((max_length, batch_size, next(seeds)),)))
 
-        for batch in results:
-          identities = np.concatenate((identities, batch))
-          generated += len(batch)
-          pbar.update(len(batch))
+      batch = pending.popleft().get()[:amount - generated]
 
-  # only keep the amount we need
-  # the first one was a dummy, discard it
-  identities = identities[1:amount+1]
+      identities[generated:generated + len(batch)] = batch
+      generated += len(batch)
+      pbar.update(len(batch))
 
-  return np.array(identities, dtype=int)
+  return identities
 
 if __name__ == "__main__":
+    sampler = IdentitySampler(MAX_LENGTH)
+
+    # random words are identities with a known probability, artificial ones always are
+    # random_words is how many rows of data are random words, everything else is artificial
+    def expected_identity_count(data, random_words):
+        return random_words * sampler.identity_probability() + len(data) - random_words
+
     # generate the training data
     train_data = generate_random_sequences(
         int(
@@ -64,6 +154,7 @@ if __name__ == "__main__":
         ),
         MAX_LENGTH
     )
+    train_random = len(train_data)
 
     if IDENTITY_PROPORTION:
         train_data = np.concatenate(
@@ -78,7 +169,7 @@ if __name__ == "__main__":
             )
         )
 
-    print("True identity count:", len(train_data[np.apply_along_axis(is_identity, 1, train_data)]))
+    print("Expected identity count:", expected_identity_count(train_data, train_random))
 
     # generate the validation data
     # the validation data has the same makeup as the training data
@@ -90,6 +181,7 @@ if __name__ == "__main__":
         ),
         MAX_LENGTH
     )
+    val_random = len(val_data)
 
     if IDENTITY_PROPORTION:
         val_data = np.concatenate((
@@ -102,7 +194,7 @@ if __name__ == "__main__":
             )
         ))
 
-    print("True identity count:", len(val_data[np.apply_along_axis(is_identity, 1, val_data)]))
+    print("Expected identity count:", expected_identity_count(val_data, val_random))
 
     # generate the artificial test data
     # the artificial test data has the same makeup as the training data
@@ -114,8 +206,12 @@ if __name__ == "__main__":
         ),
         MAX_LENGTH
     )
+    art_test_random = len(art_test_data)
 
     if IDENTITY_PROPORTION:
+        # this starts from the validation data (random words and artificial identities)
+        art_test_random = val_random
+
         art_test_data = np.concatenate((
             val_data,
             generate_identities(
@@ -126,7 +222,7 @@ if __name__ == "__main__":
             )
         ))
         
-    print("True identity count:", len(art_test_data[np.apply_along_axis(is_identity, 1, art_test_data)]))
+    print("Expected identity count:", expected_identity_count(art_test_data, art_test_random))
 
     # generate the true test data
     # the test data is completely random
@@ -139,7 +235,7 @@ if __name__ == "__main__":
         MAX_LENGTH
     )
 
-    print("True identity count:", len(true_test_data[np.apply_along_axis(is_identity, 1, true_test_data)]))
+    print("Expected identity count:", expected_identity_count(true_test_data, len(true_test_data)))
 
     # prompt: pickle the 4 datasets
     np.savetxt(PATH + "train_data.csv", train_data, delimiter=",")
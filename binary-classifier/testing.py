@@ -3,6 +3,7 @@ from config import *
 from dataloading import *
 from transformer import *
 from tqdm import tqdm
+from multiprocessing import Pool
 import matplotlib.pyplot as plt
 from sklearn.metrics import precision_recall_curve
 from sklearn.metrics import average_precision_score, accuracy_score, roc_curve, auc
@@ -10,6 +11,13 @@ from sklearn.metrics import average_precision_score, accuracy_score, roc_curve,
 TEST_TYPE = "exhaustive" # normal or exhaustive
 SHOW_PLOTS = False
 
+# how many sequences are evaluated at once in exhaustive mode
+EXHAUSTIVE_BATCHSIZE = 2**16
+
+# processes used to label every sequence in exhaustive mode
+# more than 1 relies on fork (ie. linux) since this file isn't import safe
+EXHAUSTIVE_WORKERS = 1
+
 # get the model
 model = BigramLanguageModel()
 
@@ -38,6 +46,34 @@ def generate_predictions(model, dataloader):
 
     return predictions
 
+# labels every possible sequence, in the same order as int_to_seq
+# each top level letter is a separate chunk of the search tree
+def generate_exhaustive_labels(workers=EXHAUSTIVE_WORKERS):
+    if MAX_LENGTH == 1 or workers == 1:
+        return exhaustive_labels()
+
+    prefixes = [(letter,) for letter in range(GROUP_SIZE)]
+
+    with Pool(workers) as pool:
+        return np.concatenate(pool.map(exhaustive_labels, prefixes))
+
+# runs the model on every possible sequence
+# whole ranges of indices are decoded at once and the predictions are written in place
+def generate_exhaustive_predictions(model, batch_size=EXHAUSTIVE_BATCHSIZE):
+    total = GROUP_SIZE**MAX_LENGTH
+    predictions = np.empty(total, dtype=np.float32)
+
+    with torch.inference_mode():
+        model.eval()
+
+        for start in tqdm(range(0, total, batch_size)):
+            stop = min(start + batch_size, total)
+            inputs = torch.from_numpy(ints_to_seqs(start, stop)).to(device)
+
+            predictions[start:stop] = model(inputs).reshape(-1).cpu().numpy()
+
+    return predictions
+
 def create_roc_curve(labels, predictions):    
     fpr, tpr, _ = roc_curve(labels, predictions)
 
@@ -71,10 +107,7 @@ def create_pr_curve(labels, predictions):
 
     return area_under_curve
 
-def test_suite(dataloader, labels):
-    print("Generating predictions...")
-    predictions = generate_predictions(model, dataloader)
-
+def test_suite(labels, predictions):
     print("Creating roc curve...")
     roc_auc = create_roc_curve(labels, predictions)
 
@@ -90,28 +123,28 @@ def test_suite(dataloader, labels):
     print("PR AUC:", pr_auc)
 
     print("\nIncorrect predictions:")
-    for pos, (label, prediction) in enumerate(zip(labels, predictions)):
-        if label != prediction.round():
-            print(f"Label: {label}, Prediction: {prediction}, index: {pos}")
+    for pos in np.flatnonzero(labels != predictions.round()):
+        print(f"Label: {labels[pos]}, Prediction: {predictions[pos]}, index: {pos}")
 
 #actual testing
 
 if TEST_TYPE == "normal":
     print("\nTesting artifical data...")
-    test_suite(art_test_dataloader, y_art_test)
+    print("Generating predictions...")
+    test_suite(y_art_test, generate_predictions(model, art_test_dataloader))
 
     print("\nTesting true data...")
-    test_suite(true_test_dataloader, y_true_test)
+    print("Generating predictions...")
+    test_suite(y_true_test, generate_predictions(model, true_test_dataloader))
 
 elif TEST_TYPE == "exhaustive":
     # generate all possible sequences
     print("Generating labels...")
-    labels = [is_identity(int_to_seq(x)) for x in tqdm(range(GROUP_SIZE**MAX_LENGTH))]
+    labels = generate_exhaustive_labels()
 
     print("Testing all possible sequences...")
-    full_dataset = ExhaustiveDataset(calc_identity=False)
-    full_dataloader = DataLoader(full_dataset, batch_size=64, shuffle=False, num_workers=0)
-    test_suite(full_dataloader, labels)
+    print("Generating predictions...")
+    test_suite(labels, generate_exhaustive_predictions(model))
 
 else:
     raise Exception("Invalid test type")
\ No newline at end of file
@@ -88,6 +88,28 @@ def get_permutation(sequence):
 
   return permutation
 
+# batched version of get_permutation
+# takes an (N, L) array of sequences and returns the (N, GROUP_SIZE) permutations
+# each column of transpositions is applied to every row at once
+def get_permutations(sequences):
+  sequences = np.asarray(sequences, dtype=int)
+  rows = np.arange(len(sequences))
+
+  permutations = np.tile(np.arange(GROUP_SIZE), (len(sequences), 1))
+
+  for word in sequences.T:
+    if TRANSPOSITION_TYPE == "general":
+      x = word // GROUP_SIZE
+      y = word % GROUP_SIZE
+    elif TRANSPOSITION_TYPE == "elementary":
+      # 0 is the identity, this turns it into swapping 0 with itself
+      x = np.maximum(word - 1, 0)
+      y = word
+
+    permutations[rows, x], permutations[rows, y] = permutations[rows, y], permutations[rows, x]
+
+  return permutations
+
 # used to exhaustively generate all possible sequences
 def int_to_seq(num):
   sequence = []
@@ -98,6 +120,105 @@ def int_to_seq(num):
 
   return sequence
 
+# batched version of int_to_seq
+# decodes every number in [start, stop) into its base GROUP_SIZE digits at once
+def ints_to_seqs(start, stop):
+  nums = np.arange(start, stop)
+
+  return (nums[:, np.newaxis] // GROUP_SIZE**np.arange(MAX_LENGTH)) % GROUP_SIZE
+
+# the pair of indices a letter swaps, (0, 0) means it does nothing
+def letter_to_swap(i):
+  if i and TRANSPOSITION_TYPE == "general":
+    return i // GROUP_SIZE, i % GROUP_SIZE
+  elif i and TRANSPOSITION_TYPE == "elementary":
+    return i - 1, i
+
+  return 0, 0
+
+def exhaustive_labels(prefix=(), return_permutations=False):
+  """
+    Labels every sequence that ends in prefix, in the same order as int_to_seq.
+    prefix holds the most significant letters first, so splitting on the
+    top level letters gives contiguous chunks that can go to separate processes.
+
+    This walks the tree of sequences depth first, applying one transposition per level.
+    Applying a transposition to the positions of a permutation is the same as
+    applying it to the values of the permutation built from the rest of the sequence,
+    so we can start from the most significant letter and share everything above the leaves.
+    The leaves (the least significant letter) are done all at once.
+  """
+  free = MAX_LENGTH - len(prefix)
+
+  if free < 1:
+    raise Exception("The prefix must leave at least one letter free")
+
+  swaps = [letter_to_swap(letter) for letter in range(GROUP_SIZE)]
+
+  # value_maps[letter] swaps the two values that letter moves
+  value_maps = np.tile(np.arange(GROUP_SIZE), (GROUP_SIZE, 1))
+  for letter, (x, y) in enumerate(swaps):
+    value_maps[letter, x], value_maps[letter, y] = y, x
+
+  does_nothing = np.array([x == y for x, y in swaps])
+
+  labels = np.zeros(GROUP_SIZE**free, dtype=bool)
+  permutations = np.empty((GROUP_SIZE**free, GROUP_SIZE), dtype=int) if return_permutations else None
+
+  perm = list(range(GROUP_SIZE))
+  inverse = list(range(GROUP_SIZE))
+  mismatches = 0
+  block = 0
+
+  def swap_values(x, y):
+    nonlocal mismatches
+
+    if x == y:
+      return
+
+    i, j = inverse[x], inverse[y]
+    mismatches -= (perm[i] != i) + (perm[j] != j)
+
+    perm[i], perm[j] = y, x
+    inverse[x], inverse[y] = j, i
+    mismatches += (y != i) + (x != j)
+
+  def visit(position):
+    nonlocal block
+
+    if position == 0:
+      start = block * GROUP_SIZE
+
+      # the last letter gives the identity iff it undoes what we have so far
+      if mismatches == 0:
+        labels[start:start+GROUP_SIZE] = does_nothing
+      elif mismatches == 2:
+        for letter, (x, y) in enumerate(swaps):
+          labels[start+letter] = x != y and perm[x] == y and perm[y] == x
+
+      if return_permutations:
+        permutations[start:start+GROUP_SIZE] = value_maps[:, perm]
+
+      block += 1
+      return
+
+    for letter in range(GROUP_SIZE):
+      swap_values(*swaps[letter])
+      visit(position - 1)
+
+      # transpositions undo themselves
+      swap_values(*swaps[letter])
+
+  for letter in prefix:
+    swap_values(*swaps[letter])
+
+  visit(free - 1)
+
+  if return_permutations:
+    return labels, permutations
+
+  return labels
+
 # tells you if a sequence corresponds to the identity
 # we need this because there is a non_zero chance that we generate one randomly
 # probably wouldn't be the end of the world (low chance this happens)
@@ -105,6 +226,23 @@ def int_to_seq(num):
 def is_identity(sequence):
   return get_permutation(sequence) == list(range(GROUP_SIZE))
 
+# batched version of is_identity, returns a boolean mask over the rows
+def is_identity_batch(sequences):
+  return (get_permutations(sequences) == np.arange(GROUP_SIZE)).all(axis=1)
+
+# lehmer codes give every permutation of the group a unique rank in [0, GROUP_SIZE!)
+# ranks follow lexicographic order, so the identity has rank 0
+def perm_to_rank(perm):
+  remaining = list(range(GROUP_SIZE))
+  rank = 0
+
+  for value in perm:
+    index = remaining.index(value)
+    rank = rank * len(remaining) + index
+    remaining.pop(index)
+
+  return rank
+
 # Example of accuracy calculation (you may need to adjust it based on your specific requirements)
 def calculate_accuracy(output, target):
     return (output.round() == target).float().mean()
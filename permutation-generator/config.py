@@ -12,6 +12,9 @@ MODELNAME = "shorthugegen4"
 # i recommend 64
 BATCHSIZE = 64
 
+# threads used to read the training data files
+LOAD_THREADS = 1
+
 # general or elementary
 TRANSPOSITION_TYPE = "general"
 
@@ -24,6 +27,11 @@ n_head = 6
 n_blocks = 4
 dropout = 0
 
+# do all the attention heads at once with a single fused kernel
+# checkpoints are always saved with separate heads, so either setting can load them
+# the outputs differ a tiny bit (around 1e-4) from the separate heads
+FUSED_ATTENTION = False
+
 # TRAINING HYPERPARAMETERS
 # good starting value: 3*10^-5
 learning_rate = 3*(10**-6)
@@ -4,6 +4,7 @@ from torch.utils.data import DataLoader, Dataset
 from torch import tensor, float32, cuda, device
 from scipy import sparse
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 import os
 
 class SimpleDataset(Dataset):
@@ -22,8 +23,10 @@ class SimpleDataset(Dataset):
         data = []
         targets = []
 
-        for sequence in tqdm(sequences, desc="Loading data"):
-          permutation = get_permutation(sequence)
+        # work out every permutation at once
+        permutations = get_permutations(sequences)
+
+        for sequence, permutation in tqdm(zip(sequences, permutations), desc="Loading data", total=len(sequences)):
           # word + start pred token + permutation
           new_seq = list(sequence) + [START_PREDICTION_TOKEN] + [TO_PREDICT_TOKEN for x in range(GROUP_SIZE)]
           for pos, char in enumerate(permutation):
@@ -47,25 +50,60 @@ class SimpleDataset(Dataset):
         )
         return sample
 
-# load the data
-print("Loading data...")
+# finds the training data files
+def find_shards():
+  filenames = []
+  curfile = 1
+
+  while os.path.isfile(PATH + DATA + f"train_data{curfile}.csv"):
+    filenames.append(PATH + DATA + f"train_data{curfile}.csv")
+    curfile += 1
+
+  return filenames
+
+# counts the rows of a csv without parsing it
+def count_rows(filename):
+  rows = 0
+  last = b"\n"
 
-train_data = np.array([[0 for x in range(MAX_LENGTH)]])
+  with open(filename, "rb") as file:
+    while chunk := file.read(2**24):
+      rows += chunk.count(b"\n")
+      last = chunk[-1:]
 
-curfile = 1
-while True:
-  filename = PATH + DATA + f"train_data{curfile}.csv"
+  # the last line might not end in a newline
+  return rows + (last != b"\n")
 
-  if not os.path.isfile(filename):
-     break
+# reads every shard into one preallocated array
+# this avoids concatenating, so peak memory is about the size of the dataset
+def load_shards(filenames, width, threads=LOAD_THREADS):
+  rows = [count_rows(filename) for filename in filenames]
+  offsets = np.cumsum([0] + rows)
 
-  data = np.loadtxt(filename, delimiter=",").astype(int)
+  output = np.empty((offsets[-1], width), dtype=int)
 
-  train_data = np.concatenate((train_data, data))
+  def fill(index):
+    data = np.loadtxt(filenames[index], delimiter=",", ndmin=2).astype(int)
 
-  curfile += 1
+    if len(data) != rows[index]:
+      raise Exception(f"Expected {rows[index]} rows in {filenames[index]} but found {len(data)}")
+
+    output[offsets[index]:offsets[index+1]] = data
+
+  if threads > 1:
+    with ThreadPoolExecutor(threads) as pool:
+      # list() makes sure exceptions get raised
+      list(pool.map(fill, range(len(filenames))))
+  else:
+    for index in range(len(filenames)):
+      fill(index)
+
+  return output
+
+# load the data
+print("Loading data...")
 
-train_data = train_data[1:]
+train_data = load_shards(find_shards(), MAX_LENGTH)
 DATASET_SIZE = len(train_data)
 
 val_data = np.loadtxt(PATH + DATA + "val_data.csv", delimiter=",").astype(int)
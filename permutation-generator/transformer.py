@@ -42,6 +42,23 @@ class MultiHeadAttention(nn.Module):
         self.proj = nn.Linear(n_embed, n_embed)
         self.dropout = nn.Dropout(dropout)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # split the one projection saved by FusedMultiHeadAttention back into separate heads
+        if f"{prefix}qkv.weight" in state_dict:
+            num_heads = len(self.heads)
+            weights = state_dict.pop(f"{prefix}qkv.weight").chunk(3 * num_heads, dim=0)
+
+            for index, name in enumerate(["query", "key", "value"]):
+                for head in range(num_heads):
+                    state_dict[f"{prefix}heads.{head}.{name}.weight"] = weights[index * num_heads + head]
+
+            # the fused version doesn't save the masks, they're always the same anyway
+            for head, module in enumerate(self.heads):
+                for name, buffer in module.named_buffers(recurse=False):
+                    state_dict.setdefault(f"{prefix}heads.{head}.{name}", buffer)
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x):
         return self.dropout(
             self.proj(
@@ -49,6 +66,75 @@ class MultiHeadAttention(nn.Module):
             )
         )
 
+class FusedMultiHeadAttention(nn.Module):
+    """
+        Same maths as MultiHeadAttention, but all the heads are done at once
+        with one projection and F.scaled_dot_product_attention.
+        Checkpoints are saved and loaded with separate heads, like MultiHeadAttention,
+        so they work with everything that reads the old layout.
+    """
+
+    def __init__(self, num_heads, head_size):
+        super().__init__()
+        self.num_heads = num_heads
+        self.head_size = head_size
+
+        # queries, then keys, then values, each one split up into heads
+        self.qkv = nn.Linear(n_embed, 3 * num_heads * head_size, bias=False)
+        self.proj = nn.Linear(n_embed, n_embed)
+        self.dropout = nn.Dropout(dropout)
+
+        # checkpoints are saved with separate heads
+        self._register_state_dict_hook(FusedMultiHeadAttention._save_separate_heads)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # turn the weights of separate heads into one projection
+        if f"{prefix}heads.0.query.weight" in state_dict:
+            weights = {"query": [], "key": [], "value": []}
+
+            for head in range(self.num_heads):
+                for name in weights:
+                    weights[name].append(state_dict.pop(f"{prefix}heads.{head}.{name}.weight"))
+
+            state_dict[f"{prefix}qkv.weight"] = torch.cat(
+                weights["query"] + weights["key"] + weights["value"], dim=0
+            )
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _save_separate_heads(self, destination, prefix, local_metadata):
+        # split the projection up so the checkpoint has the same keys as MultiHeadAttention
+        # this runs after qkv has saved its weight
+        weights = destination.pop(f"{prefix}qkv.weight").chunk(3 * self.num_heads, dim=0)
+
+        for head in range(self.num_heads):
+            for index, name in enumerate(["query", "key", "value"]):
+                # copied, safetensors won't save tensors that share memory
+                destination[f"{prefix}heads.{head}.{name}.weight"] = weights[index * self.num_heads + head].clone()
+
+    def forward(self, x):
+        B, T, C = x.shape
+
+        # (B, T, 3*C) -> 3 lots of (B, n_head, T, head_size)
+        q, k, v = self.qkv(x).view(B, T, 3, self.num_heads, self.head_size).permute(2, 0, 3, 1, 4)
+
+        out = F.scaled_dot_product_attention(
+            q, k, v,
+            dropout_p=dropout if self.training else 0,
+            scale=C**-0.5
+        )
+
+        # put the heads back side by side
+        out = out.transpose(1, 2).reshape(B, T, C)
+
+        return self.dropout(self.proj(out))
+
+# pick which attention the model is built with
+if FUSED_ATTENTION:
+    Attention = FusedMultiHeadAttention
+else:
+    Attention = MultiHeadAttention
+
 class FeedForward(nn.Module):
     def __init__(self, n_embed):
         super().__init__()
@@ -69,7 +155,7 @@ class Block(nn.Module):
         super().__init__()
         head_size = n_embed // n_head
 
-        self.sa = MultiHeadAttention(n_head, head_size)
+        self.sa = Attention(n_head, head_size)
         self.ffwd = FeedForward(n_embed)
 
         self.ln1 = nn.LayerNorm(n_embed)
@@ -90,7 +176,7 @@ class BigramLanguageModel(nn.Module):
         self.token_embedding_table = nn.Embedding(vocab_size, n_embed)
         self.position_embedding = nn.Embedding(block_size, n_embed)
 
-        self.sa_heads = MultiHeadAttention(n_head, n_embed//n_head)
+        self.sa_heads = Attention(n_head, n_embed//n_head)
         self.blocks = [Block(n_embed, n_head) for _ in range(n_blocks)]
         self.blocks.append(nn.LayerNorm(n_embed))
 
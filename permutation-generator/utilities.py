@@ -89,6 +89,28 @@ def get_permutation(sequence):
 
   return permutation
 
+# batched version of get_permutation
+# takes an (N, L) array of sequences and returns the (N, GROUP_SIZE) permutations
+# each column of transpositions is applied to every row at once
+def get_permutations(sequences):
+  sequences = np.asarray(sequences, dtype=int)
+  rows = np.arange(len(sequences))
+
+  permutations = np.tile(np.arange(GROUP_SIZE), (len(sequences), 1))
+
+  for word in sequences.T:
+    if TRANSPOSITION_TYPE == "general":
+      x = word // GROUP_SIZE
+      y = word % GROUP_SIZE
+    elif TRANSPOSITION_TYPE == "elementary":
+      # 0 is the identity, this turns it into swapping 0 with itself
+      x = np.maximum(word - 1, 0)
+      y = word
+
+    permutations[rows, x], permutations[rows, y] = permutations[rows, y], permutations[rows, x]
+
+  return permutations
+
 # used to exhaustively generate all possible sequences
 def int_to_seq(num):
   sequence = []
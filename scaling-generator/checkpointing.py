@@ -0,0 +1,214 @@
+from config import *
+from accelerate.utils import DistributedType
+from safetensors.torch import save_file, load_file
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import random
+import shutil
+import copy
+import json
+import os
+
+# saves everything needed to carry on training from exactly where it stopped
+# (model, optimizer, scheduler, every process' random state and how far through the epoch we were)
+# the main process copies the state to the cpu straight away, then writes it to disk on a background thread
+# so the gpus can keep training while the files get written
+
+CHECKPOINT_PREFIX = "step_"
+
+def to_cpu(state):
+    # copies every tensor in a nested state dict to the cpu
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    elif isinstance(state, dict):
+        return {key: to_cpu(value) for key, value in state.items()}
+    elif isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(value) for value in state)
+
+    return copy.deepcopy(state)
+
+def rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state()
+    }
+
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+
+    return state
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+class CheckpointManager:
+    """
+        Writes a checkpoint every `every` steps into directory/step_<global step>
+        and keeps the newest `keep` of them.
+        Checkpoints are written into a .tmp directory and renamed when they're done,
+        so anything without .tmp on the end is complete.
+        With deepspeed the optimizer is split between the processes,
+        so accelerate writes those checkpoints instead, and that isn't in the background.
+    """
+
+    def __init__(self, accelerator, directory, every=CHECKPOINT_EVERY_STEPS, keep=CHECKPOINTS_KEPT):
+        # resuming needs at least the newest checkpoint
+        if keep < 1:
+            raise Exception("At least one checkpoint has to be kept")
+
+        self.accelerator = accelerator
+        self.directory = directory
+        self.every = every
+        self.keep = keep
+
+        # one write at a time, so there's at most one snapshot waiting in memory
+        self.writer = ThreadPoolExecutor(1)
+        self.pending = None
+
+        if accelerator.is_main_process:
+            os.makedirs(directory, exist_ok=True)
+
+            # anything left half written by a run that got killed
+            for name in os.listdir(directory):
+                if name.endswith(".tmp"):
+                    shutil.rmtree(f"{directory}/{name}")
+
+        accelerator.wait_for_everyone()
+
+    def should_save(self, global_step):
+        return self.every is not None and global_step % self.every == 0
+
+    def checkpoints(self):
+        names = [
+            name for name in os.listdir(self.directory)
+            if name.startswith(CHECKPOINT_PREFIX) and not name.endswith(".tmp")
+        ]
+
+        return sorted(names, key=lambda name: int(name[len(CHECKPOINT_PREFIX):]))
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+
+        if not checkpoints:
+            return None
+
+        return f"{self.directory}/{checkpoints[-1]}"
+
+    def wait(self):
+        # raises any error from the last write
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def save(self, model, optimizer, scheduler, progress, export_to=None):
+        """
+            progress is a json friendly dict of where we are in training.
+            If export_to is given, the weights are also written to export_to/model.safetensors
+            like accelerator.save_model does (with deepspeed that's what writes them).
+        """
+        self.wait()
+
+        accelerator = self.accelerator
+        final = f"{self.directory}/{CHECKPOINT_PREFIX}{progress['global_step']}"
+        temporary = final + ".tmp"
+
+        if accelerator.is_main_process:
+            os.makedirs(temporary, exist_ok=True)
+
+        accelerator.wait_for_everyone()
+
+        # the random state is tiny, so every process just writes its own straight away
+        torch.save(rng_state(), f"{temporary}/rng_{accelerator.process_index}.pt")
+
+        if accelerator.distributed_type == DistributedType.DEEPSPEED:
+            accelerator.save_state(f"{temporary}/accelerate")
+            model_state = None
+
+            # the weights are split up too, so accelerate has to put them back together for the export
+            if export_to is not None:
+                accelerator.save_model(model, export_to)
+        else:
+            # every process has to ask for the state (fsdp gathers it), but only the main one writes it
+            # so the others don't copy it, they'd just be using up time and memory
+            model_state = accelerator.get_state_dict(model)
+
+            if accelerator.is_main_process:
+                model_state = to_cpu(model_state)
+
+        accelerator.wait_for_everyone()
+
+        if not accelerator.is_main_process:
+            return
+
+        snapshot = {
+            "model": model_state,
+            "optimizer": to_cpu(optimizer.state_dict()) if model_state is not None else None,
+            "scheduler": to_cpu(scheduler.state_dict()),
+            "progress": copy.deepcopy(progress)
+        }
+
+        self.pending = self.writer.submit(self.write, snapshot, temporary, final, export_to)
+
+    def write(self, snapshot, temporary, final, export_to):
+        if snapshot["model"] is not None:
+            save_file(snapshot["model"], f"{temporary}/model.safetensors")
+            torch.save(snapshot["optimizer"], f"{temporary}/optimizer.pt")
+
+        torch.save(snapshot["scheduler"], f"{temporary}/scheduler.pt")
+
+        # written last, so a checkpoint with progress.json has everything else
+        with open(f"{temporary}/progress.json", "w") as file:
+            json.dump(snapshot["progress"], file)
+
+        # the checkpoint at the end of an epoch can land on the same step as the one before it
+        if os.path.isdir(final):
+            shutil.rmtree(final)
+
+        os.replace(temporary, final)
+
+        if export_to is not None and snapshot["model"] is not None:
+            os.makedirs(export_to, exist_ok=True)
+            save_file(snapshot["model"], f"{export_to}/model.safetensors.tmp")
+            os.replace(f"{export_to}/model.safetensors.tmp", f"{export_to}/model.safetensors")
+
+        # only keep the newest few
+        for name in self.checkpoints()[:-self.keep]:
+            shutil.rmtree(f"{self.directory}/{name}")
+
+    def load(self, model, optimizer, scheduler, path=None):
+        """
+            Loads a checkpoint (the latest one by default) into already prepared objects.
+            Returns its progress, or None if there's no checkpoint.
+        """
+        path = path or self.latest()
+
+        if path is None:
+            return None
+
+        accelerator = self.accelerator
+
+        if os.path.isdir(f"{path}/accelerate"):
+            accelerator.load_state(f"{path}/accelerate")
+        else:
+            accelerator.unwrap_model(model).load_state_dict(load_file(f"{path}/model.safetensors"))
+            optimizer.load_state_dict(torch.load(f"{path}/optimizer.pt", weights_only=False))
+
+        scheduler.load_state_dict(torch.load(f"{path}/scheduler.pt", weights_only=False))
+
+        # a different number of processes than last time just falls back to the main one's state
+        rng_file = f"{path}/rng_{accelerator.process_index}.pt"
+
+        if not os.path.isfile(rng_file):
+            rng_file = f"{path}/rng_0.pt"
+
+        set_rng_state(torch.load(rng_file, weights_only=False))
+
+        with open(f"{path}/progress.json", "r") as file:
+            return json.load(file)
@@ -98,6 +98,16 @@ n_head = 6
 n_blocks = 5
 dropout = 0
 
+# do all the attention heads at once with a single fused kernel
+# checkpoints are always saved with separate heads, so either setting can load them
+# the outputs differ a tiny bit (around 1e-4) from the separate heads
+# hooks on the attention are still supported, but make it slower
+FUSED_ATTENTION = False
+
+# compile the model with torch.compile for training and testing
+# all the shapes are fixed, so the last uneven training batch is dropped
+COMPILE_MODEL = False
+
 # TRAINING HYPERPARAMETERS
 # good starting value: 3*10^-5
 learning_rate = 3*(10**-4)
@@ -113,5 +123,73 @@ lr_factor = 0.1  # Factor by which the learning rate will be reduced
 lr_patience = 10  # Number of epochs with no improvement after which learning rate will be reduced
 threshold = 0.01  # Threshold for measuring the new optimum
 
+# how often the training stats get logged, in steps
+# they're kept on the device in between so the training loop doesn't have to wait for them
+LOG_EVERY_STEPS = 100
+
+# full training checkpoints, so a run can carry on from where it stopped
+# None turns off the checkpoints between epochs, there's always one at the end of an epoch
+CHECKPOINT_EVERY_STEPS = 1000
+CHECKPOINTS_KEPT = 3
+RESUME = True
+
+# validation settings
+# mode is full (the whole validation set) or subset (the same random EVAL_SUBSET_SIZE rows every time)
+# there's always an evaluation at the end of an epoch, EVAL_EVERY_STEPS adds more in between (None turns them off)
+EVAL_MODE = "full"
+EVAL_SUBSET_SIZE = 2**14
+EVAL_EVERY_STEPS = None
+
+# how many test sequences are generated at once
+TEST_BATCHSIZE = 256
+
+# how testing and the server decode
+# can be greedy (one token at a time), beam (beam search, see below)
+# or parallel (jacobi decoding, every token at once until the guess stops changing)
+# parallel gives the same permutations as greedy
+DECODING = "greedy"
+
+# beam search settings
+# a width of 1 is the same as greedy decoding
+# tie break can be stable or fast
+BEAM_WIDTH = 1
+BEAM_TIE_BREAK = "stable"
+
 # for dataloading
-N_WORKERS = 0
\ No newline at end of file
+N_WORKERS = 0
+LOAD_THREADS = 1 # threads used to read the training shards
+
+# stream the training data from disk instead of loading it all into memory
+# requires the binary dataset format (see convert_data.py)
+STREAMING = False
+STREAM_CHUNK_SIZE = 2**16 # rows read from a shard at once
+STREAM_BUFFER_SIZE = 2**20 # rows shuffled together
+
+# make fresh training data in the dataloader workers instead of reading it from disk
+# the words are made like fast-data-gen makes them, using the group size and window settings above
+# there's no real epoch, so ONLINE_EPOCH_SIZE is just how many rows there are between evaluations
+ONLINE_DATA = False
+ONLINE_EPOCH_SIZE = 2**24
+ONLINE_SEED = 0
+
+# make the validation and test sets from a seed instead of reading them from disk
+# row i of a split only depends on (seed, i), so nothing is stored and any process can make any rows
+# the seeds must be different from each other
+VIRTUAL_EVAL = False
+VAL_SEED = 1
+VAL_SIZE = 2**16
+TEST_SEED = 2
+TEST_SIZE = 2**16
+
+# batch words of similar length together and cut off the padding
+# zeroes are moved to the end of each word first, which only makes sense when 0 is the identity
+# so this is only for elementary and general inputs
+# the model never attends to those zeroes, so a word's output doesn't depend on its batch
+# models trained without this attend to them, so keep the setting the model was trained with
+BUCKETED_BATCHES = False
+
+# for the inference server (see server.py)
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8000
+SERVER_MAX_BATCH = TEST_BATCHSIZE # most sequences generated at once
+SERVER_MAX_WAIT = 0.005 # seconds to wait for more requests before generating
\ No newline at end of file
@@ -0,0 +1,55 @@
+from config import *
+from dataloading import find_csv_shards, read_array, MANIFEST_NAME
+from tqdm import tqdm
+import numpy as np
+import json
+import os
+
+# converts the csv shards made by fast-data-gen into raw binary shards
+# load_data memory maps these instead of parsing the csvs
+# only needs to be run once per dataset
+
+def smallest_dtype(array):
+    # everything we store is a non-negative token or index
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if array.max(initial=0) <= np.iinfo(dtype).max:
+            return np.dtype(dtype).name
+
+    return np.dtype(np.int64).name
+
+def convert_array(entry):
+    array = read_array(entry)
+    dtype = smallest_dtype(array)
+
+    filename = entry["file"].replace(".csv", ".bin")
+    array.astype(dtype).tofile(PATH + DATA + filename)
+
+    return {
+        "file": filename,
+        "shape": list(array.shape),
+        "dtype": dtype
+    }
+
+def convert_data():
+    manifest = {"version": 1, "splits": {}}
+
+    for split in ["train", "val", "test"]:
+        manifest["splits"][split] = [
+            {
+                "inputs": convert_array(shard["inputs"]),
+                "perms": convert_array(shard["perms"])
+            }
+            for shard in tqdm(find_csv_shards(split), desc=f"Converting {split} data")
+        ]
+
+    # write the manifest last and atomically
+    # so a half finished conversion never gets picked up by load_data
+    filename = PATH + DATA + MANIFEST_NAME
+
+    with open(filename + ".tmp", "w") as file:
+        json.dump(manifest, file, indent=2)
+
+    os.replace(filename + ".tmp", filename)
+
+if __name__ == "__main__":
+    convert_data()
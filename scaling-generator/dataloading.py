@@ -1,12 +1,48 @@
 from utilities import *
 from config import *
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
 from torch import tensor, float32, cuda, device
 from scipy import sparse
 from tqdm import tqdm
 from accelerate import Accelerator
+from generation import GeneratedDataset, VirtualDataset
+import torch
+from concurrent.futures import ThreadPoolExecutor
+import json
 import os
 
+def build_masked_rows(sequences, permutations):
+  """
+    Builds the inputs and targets of MaskedDataset for every pair at once.
+    Row i is the sequence, the start token and the shifted permutation
+    without its last token. The target is the whole shifted permutation.
+  """
+  sequences = np.asarray(sequences, dtype=np.int64)
+
+  # shift the permutations to use the correct tokens
+  # we don't want overlap between the input tokens and the output tokens
+  shifted_perms = np.asarray(permutations, dtype=np.int64) + num_trans
+  start = np.full((len(sequences), 1), START_PREDICTION_TOKEN, dtype=np.int64)
+
+  data = np.concatenate((sequences, start, shifted_perms[:, :-1]), axis=1)
+
+  return tensor(data), tensor(shifted_perms)
+
+def build_reversed_rows(sequences, permutations):
+  """
+    Same as build_masked_rows but for ReversedDataset,
+    so the permutation is the input and the sequence is the target.
+  """
+  sequences = np.asarray(sequences, dtype=np.int64)
+
+  # we keep the tokens the same as in the normal problem to make things easier
+  shifted_perms = np.asarray(permutations, dtype=np.int64) + num_trans
+  start = np.full((len(sequences), 1), START_PREDICTION_TOKEN, dtype=np.int64)
+
+  data = np.concatenate((shifted_perms, start, sequences[:, :-1]), axis=1)
+
+  return tensor(data), tensor(sequences)
+
 class SimpleDataset(Dataset):
     def __init__(self, sequences, permutations, *args, **kwargs):
         # use gpu for processing
@@ -58,34 +94,15 @@ class SimpleDataset(Dataset):
 
 class MaskedDataset(Dataset):
     def __init__(self, sequences, permutations, mainthread, *args, **kwargs):
-        # use gpu for processing
         if type(sequences) == sparse._csr.csr_matrix:
           sequences = sequences.todense()
 
-        data = []
-        targets = []
-
         # generate the input output pairs
-        # we're basically simulating what the autoregression process would look like
-        for sequence, permutation in tqdm(
-           zip(sequences, permutations), 
-           desc="Loading data", 
-           disable=not mainthread
-        ):
-          # shift the permutation to use the correct tokens
-          # we don't want overlap between the input tokens and the output tokens
-          shifted_perm = convert_perm_to_tokens(permutation)
-
-          model_input = list(sequence) + [START_PREDICTION_TOKEN] + list(shifted_perm)[:-1]
-
-          # create target
-          target = shifted_perm
-
-          data.append(model_input)
-          targets.append(target) 
+        # the mask lets us train every autoregression step from one row
+        self.data, self.targets = build_masked_rows(sequences, permutations)
 
-        self.data = tensor(data, dtype=int)
-        self.targets = tensor(targets, dtype=int)
+    # lets StreamingDataset build rows the same way
+    build_rows = staticmethod(build_masked_rows)
 
     def __len__(self):
         return len(self.data)
@@ -99,35 +116,13 @@ class MaskedDataset(Dataset):
 
 class ReversedDataset(Dataset):
     def __init__(self, sequences, permutations, mainthread, *args, **kwargs):
-        # use gpu for processing
         if type(sequences) == sparse._csr.csr_matrix:
           sequences = sequences.todense()
 
-        data = []
-        targets = []
-
         # generate the input output pairs
-        # we're basically simulating what the autoregression process would look like
-        for sequence, permutation in tqdm(
-           zip(sequences, permutations), 
-           desc="Loading data", 
-           disable=not mainthread
-        ):
-          # shift the permutation to use the correct tokens
-          # we don't want overlap between the input tokens and the output tokens
-          # we keep the tokens the same as in the normal problem to make things easier
-          shifted_perm = convert_perm_to_tokens(permutation)
-
-          model_input = list(shifted_perm) + [START_PREDICTION_TOKEN] + list(sequence)[:-1]
+        self.data, self.targets = build_reversed_rows(sequences, permutations)
 
-          # create target
-          target = sequence
-
-          data.append(model_input)
-          targets.append(target) 
-
-        self.data = tensor(np.array(data), dtype=int)
-        self.targets = tensor(np.array(targets), dtype=int)
+    build_rows = staticmethod(build_reversed_rows)
 
     def __len__(self):
         return len(self.data)
@@ -191,67 +186,439 @@ class ProbeDataset(Dataset):
         )
         return sample
 
+# describes a dataset that has been converted to the binary format
+# see convert_data.py
+MANIFEST_NAME = "manifest.json"
+
+def read_manifest():
+  filename = PATH + DATA + MANIFEST_NAME
+
+  if not os.path.isfile(filename):
+    return None
+
+  with open(filename, "r") as file:
+    return json.load(file)
+
+def find_csv_shards(split):
+  """
+    Lists the csv shards of a split ("train", "val" or "test")
+    in the format used by the manifest.
+  """
+  if split != "train":
+    return [{
+      "inputs": {"file": f"{split}_data.csv"},
+      "perms": {"file": f"{split}_data_perms.csv"}
+    }]
+
+  shards = []
+  curfile = 1
+
+  while os.path.isfile(PATH + DATA + f"train_data{curfile}.csv"):
+    shards.append({
+      "inputs": {"file": f"train_data{curfile}.csv"},
+      "perms": {"file": f"train_data{curfile}_perms.csv"}
+    })
+
+    curfile += 1
+
+  return shards
+
+def find_shards(split):
+  """
+    Lists the shards of a split, preferring the binary format if it exists.
+  """
+  manifest = read_manifest()
+
+  if manifest is None:
+    return find_csv_shards(split)
+
+  return manifest["splits"][split]
+
+def read_array(entry):
+  """
+    Opens one half of a shard.
+    Binary shards are memory mapped, so this is basically free.
+  """
+  filename = PATH + DATA + entry["file"]
+
+  if "dtype" not in entry:
+    return np.loadtxt(filename, delimiter=",", ndmin=2).astype(int)
+
+  return np.memmap(filename, dtype=entry["dtype"], mode="r", shape=tuple(entry["shape"]))
+
+def read_shard(shard):
+  return read_array(shard["inputs"]), read_array(shard["perms"])
+
+def count_rows(entry):
+  if "shape" in entry:
+    return entry["shape"][0]
+
+  # count the lines of the csv without parsing it
+  rows = 0
+  last = b"\n"
+
+  with open(PATH + DATA + entry["file"], "rb") as file:
+    while chunk := file.read(2**24):
+      rows += chunk.count(b"\n")
+      last = chunk[-1:]
+
+  # the last line might not end in a newline
+  return rows + (last != b"\n")
+
+def load_shards(entries, width, threads=LOAD_THREADS):
+  """
+    Reads shard halves into one preallocated array.
+    The rows are counted up front so nothing is ever concatenated,
+    which keeps the peak memory at about the size of the dataset.
+  """
+  rows = [count_rows(entry) for entry in entries]
+  offsets = np.cumsum([0] + rows)
+
+  output = np.empty((offsets[-1], width), dtype=int)
+
+  def fill(index):
+    array = read_array(entries[index])
+
+    if len(array) != rows[index]:
+      raise Exception(f"Expected {rows[index]} rows in {entries[index]['file']} but found {len(array)}")
+
+    output[offsets[index]:offsets[index+1]] = array
+
+  if threads > 1:
+    with ThreadPoolExecutor(threads) as pool:
+      # list() makes sure exceptions get raised
+      list(pool.map(fill, range(len(entries))))
+  else:
+    for index in range(len(entries)):
+      fill(index)
+
+  return output
+
+def split_evenly(total, parts, part):
+  # the (start, stop) of one part, the same split as np.array_split
+  size, remainder = divmod(total, parts)
+  start = part * size + min(part, remainder)
+
+  return start, start + size + (part < remainder)
+
+class StreamingDataset(IterableDataset):
+    """
+        Streams the training shards from disk instead of loading them into memory.
+        The rows are split between the processes as evenly as possible, and a process
+        that's one row short reads the first row again, so every process sees the same
+        number of batches. Each process's rows are then split between its dataloader
+        workers in whole batches. Every worker reads its rows in chunks, shuffles them
+        within a bounded buffer and yields whole batches,
+        so use it with DataLoader(batch_size=None).
+    """
+
+    def __init__(
+            self, 
+            shards, 
+            dataset_class=MaskedDataset, 
+            process_index=0, 
+            num_processes=1,
+            batch_size=BATCHSIZE,
+            chunk_size=STREAM_CHUNK_SIZE,
+            buffer_size=STREAM_BUFFER_SIZE,
+            seed=0,
+            drop_last=False
+        ):
+        if not hasattr(dataset_class, "build_rows"):
+            raise Exception(f"{dataset_class.__name__} does not support streaming")
+
+        self.shards = shards
+        self.build_rows = dataset_class.build_rows
+        self.process_index = process_index
+        self.num_processes = num_processes
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        self.offsets = np.cumsum([0] + [shard["inputs"]["shape"][0] for shard in shards])
+        total = self.offsets[-1]
+
+        start, stop = split_evenly(total, num_processes, process_index)
+
+        # rows every process reads
+        self.rows = -(-total // num_processes)
+
+        # the (start, stop) ranges of the rows this process reads, in order
+        self.ranges = [(start, stop)]
+
+        if stop - start < self.rows:
+            self.ranges.append((0, 1))
+
+    def set_epoch(self, epoch):
+        # changes the shuffle
+        self.epoch = epoch
+
+    def __len__(self):
+        # number of batches this process will see, however many workers there are
+        if self.drop_last:
+            return self.rows // self.batch_size
+
+        return -(-self.rows // self.batch_size)
+
+    def worker(self):
+        worker_info = get_worker_info()
+
+        if worker_info is None:
+            return 0, 1
+
+        return worker_info.id, worker_info.num_workers
+
+    def chunks(self, worker, num_workers):
+        """
+            The chunks of rows this worker reads, as (shard, start, stop).
+            Workers get whole batches of the process's rows, so only the last
+            worker with any rows can end up with a partial batch.
+            Chunks never cross shard boundaries.
+        """
+        first, last = split_evenly(-(-self.rows // self.batch_size), num_workers, worker)
+        start, stop = first * self.batch_size, min(last * self.batch_size, self.rows)
+
+        chunks = []
+        done = 0
+
+        for range_start, range_stop in self.ranges:
+            # the part of this range that falls in start:stop
+            low = range_start + max(0, start - done)
+            high = range_start + min(range_stop - range_start, stop - done)
+            done += range_stop - range_start
+
+            for shard_index, (shard_start, shard_stop) in enumerate(zip(self.offsets, self.offsets[1:])):
+                for chunk_start in range(max(low, shard_start), min(high, shard_stop), self.chunk_size):
+                    chunk_stop = min(chunk_start + self.chunk_size, high, shard_stop)
+                    chunks.append((shard_index, chunk_start - shard_start, chunk_stop - shard_start))
+
+        return chunks
+
+    def shuffled_batches(self, pending, generator, final):
+        data = torch.cat([rows for rows, _ in pending])
+        targets = torch.cat([targets for _, targets in pending])
+
+        order = torch.from_numpy(generator.permutation(len(data)))
+        data, targets = data[order], targets[order]
+
+        # keep the leftovers for the next buffer so we don't make lots of small batches
+        if final and not self.drop_last:
+            cutoff = len(data)
+        else:
+            cutoff = len(data) - len(data) % self.batch_size
+
+        for start in range(0, cutoff, self.batch_size):
+            yield data[start:start+self.batch_size], targets[start:start+self.batch_size]
+
+        return [(data[cutoff:], targets[cutoff:])]
+
+    def __iter__(self):
+        worker, num_workers = self.worker()
+        generator = np.random.default_rng([self.seed, self.epoch, self.process_index, worker])
+
+        chunks = self.chunks(worker, num_workers)
+
+        pending = []
+        pending_rows = 0
+
+        for chunk in generator.permutation(len(chunks)):
+            shard_index, start, stop = chunks[chunk]
+            inputs, perms = read_shard(self.shards[shard_index])
+
+            pending.append(self.build_rows(inputs[start:stop], perms[start:stop]))
+            pending_rows += stop - start
+
+            if pending_rows >= self.buffer_size:
+                pending = yield from self.shuffled_batches(pending, generator, final=False)
+                pending_rows = len(pending[0][0])
+
+        if pending_rows:
+            yield from self.shuffled_batches(pending, generator, final=True)
+
+class LengthBucketSampler:
+    """
+        Batch sampler that puts words of similar length in the same batch.
+        Rows are sorted by length (ties are broken randomly when shuffling),
+        cut into batches, and then the order of the batches is shuffled.
+        Use with DataLoader(batch_sampler=...) and trim_collate.
+    """
+
+    def __init__(self, lengths, batch_size=BATCHSIZE, shuffle=True, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+
+        # every process needs to make the same batches, so the shuffle only depends on these
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        # changes the shuffle
+        self.epoch = epoch
+
+    def __len__(self):
+        return -(-len(self.lengths) // self.batch_size)
+
+    def __iter__(self):
+        generator = np.random.default_rng([self.seed, self.epoch])
+
+        if self.shuffle:
+            order = np.lexsort((generator.random(len(self.lengths)), self.lengths))
+        else:
+            order = np.argsort(self.lengths, kind="stable")
+
+        batches = [order[start:start+self.batch_size] for start in range(0, len(order), self.batch_size)]
+
+        if self.shuffle:
+            batches = [batches[index] for index in generator.permutation(len(batches))]
+
+        for batch in batches:
+            yield batch.tolist()
+
+def trim_collate(batch):
+  """
+    Stacks a batch of MaskedDataset rows whose zeroes have been moved to the end,
+    then cuts the input down to the longest word in the batch.
+    The model works out the positions from the shorter length,
+    and doesn't attend to the zeroes left at the end of the shorter words.
+  """
+  data = torch.stack([row for row, _ in batch])
+  targets = torch.stack([target for _, target in batch])
+
+  # keep at least one token so the input is never empty
+  input_length = max(1, (data[:, :INPUT_LENGTH] != 0).sum(dim=1).max().item())
+
+  data = torch.cat((data[:, :input_length], data[:, INPUT_LENGTH:]), dim=1)
+
+  return data, targets
+
+def bucketed_dataloader(dataset, sequences, shuffle):
+  lengths = (np.asarray(sequences) != 0).sum(axis=1)
+
+  return DataLoader(
+    dataset, 
+    batch_sampler=LengthBucketSampler(lengths, BATCHSIZE, shuffle), 
+    collate_fn=trim_collate, 
+    num_workers=N_WORKERS
+  )
+
 def load_data(dataset_class=MaskedDataset, question=None, skip_train=False, verbose=False):
   accelerator = Accelerator()
   should_speak = verbose and accelerator.is_local_main_process
 
-  train_inputs = np.array([[0 for x in range(INPUT_LENGTH)]])
-  train_perms = np.array([[0 for x in range(MAX_GROUP_SIZE)]])
-
-  if not skip_train:
-    if should_speak:
-     print("Loading training data...")
+  if BUCKETED_BATCHES:
+    if INPUT_TYPE not in ["elementary", "general"]:
+      raise Exception("Bucketed batches need 0 to be the identity, so only work for elementary or general inputs")
     
-    curfile = 1
+    if STREAMING or ONLINE_DATA or dataset_class is not MaskedDataset:
+      raise Exception("Bucketed batches only work with MaskedDataset and data loaded from disk")
 
-    while True:
-      filename = PATH + DATA + f"train_data{curfile}.csv"
-      perm_filename = PATH + DATA + f"train_data{curfile}_perms.csv"
+  if STREAMING and ONLINE_DATA:
+    raise Exception("Generated data isn't read from disk, so it can't be streamed")
 
-      if not os.path.isfile(filename):
-        break
+  if BUCKETED_BATCHES and VIRTUAL_EVAL:
+    raise Exception("Bucketed batches need the validation and test data in memory, so they don't work with VIRTUAL_EVAL")
 
-      data = np.loadtxt(filename, delimiter=",").astype(int)
-      perms = np.loadtxt(perm_filename, delimiter=",").astype(int)
+  if VIRTUAL_EVAL and VAL_SEED == TEST_SEED:
+    raise Exception("The validation and test sets need different seeds")
 
-      train_inputs = np.concatenate((train_inputs, data))
-      train_perms = np.concatenate((train_perms, perms))
+  if not skip_train and ONLINE_DATA:
+    # the rows are made by the dataset as they're needed
+    train_inputs = None
+    train_perms = None
+    dataset_size = ONLINE_EPOCH_SIZE
+  elif not skip_train and STREAMING:
+    if read_manifest() is None:
+      raise Exception("Streaming requires the binary dataset format, run convert_data.py first")
+
+    # the rows are read lazily by the dataset
+    train_inputs = None
+    train_perms = None
+    train_shards = find_shards("train")
+    dataset_size = sum(shard["inputs"]["shape"][0] for shard in train_shards)
+  elif not skip_train:
+    if should_speak:
+     print("Loading training data...")
 
-      curfile += 1
+    train_shards = find_shards("train")
 
-    train_inputs = train_inputs[1:]
-    train_perms = train_perms[1:]
+    train_inputs = load_shards([shard["inputs"] for shard in train_shards], INPUT_LENGTH)
+    train_perms = load_shards([shard["perms"] for shard in train_shards], MAX_GROUP_SIZE)
     dataset_size = len(train_inputs)
   else:
     train_inputs = None
     train_perms = None
     dataset_size = None
 
-  if should_speak:
-     print("Loading validation data...")
+  if VIRTUAL_EVAL:
+    # the rows get made when they're used
+    val_dataset = VirtualDataset(dataset_class, VAL_SIZE, VAL_SEED)
+    test_dataset = VirtualDataset(dataset_class, TEST_SIZE, TEST_SEED)
+
+    val_seqs, val_perms = val_dataset.sequences, val_dataset.permutations
+    test_seqs, test_perms = test_dataset.sequences, test_dataset.permutations
+  else:
+    if should_speak:
+      print("Loading validation data...")
+
+    val_seqs, val_perms = read_shard(find_shards("val")[0])
+
+    if should_speak:
+      print("Loading test data...")
 
-  val_seqs = np.loadtxt(PATH + DATA + "val_data.csv", delimiter=",").astype(int)
-  val_perms = np.loadtxt(PATH + DATA + "val_data_perms.csv", delimiter=",").astype(int)
+    test_seqs, test_perms = read_shard(find_shards("test")[0])
 
-  if should_speak:
-     print("Loading test data...")
+  if BUCKETED_BATCHES:
+    shifter = ZeroShifter()
 
-  test_seqs = np.loadtxt(PATH + DATA + "test_data.csv", delimiter=",").astype(int)
-  test_perms = np.loadtxt(PATH + DATA + "test_data_perms.csv", delimiter=",").astype(int)
+    if not skip_train:
+      train_inputs = shifter.transform(train_inputs)
+    
+    val_seqs = shifter.transform(val_seqs)
+    test_seqs = shifter.transform(test_seqs)
 
   # create the dataloaders
-  if not skip_train:
+  if not skip_train and ONLINE_DATA:
+    train_dataset = GeneratedDataset(
+      dataset_class,
+      process_index=accelerator.process_index,
+      num_processes=accelerator.num_processes
+    )
+    train_dataloader = DataLoader(train_dataset, batch_size=None, num_workers=N_WORKERS)
+  elif not skip_train and STREAMING:
+    train_dataset = StreamingDataset(
+      train_shards,
+      dataset_class,
+      process_index=accelerator.process_index,
+      num_processes=accelerator.num_processes,
+      drop_last=COMPILE_MODEL
+    )
+    train_dataloader = DataLoader(train_dataset, batch_size=None, num_workers=N_WORKERS)
+  elif not skip_train:
     train_dataset = dataset_class(train_inputs, train_perms, question=question, mainthread=should_speak)
-    train_dataloader = DataLoader(train_dataset, batch_size=BATCHSIZE, num_workers=N_WORKERS)
+
+    if BUCKETED_BATCHES:
+      train_dataloader = bucketed_dataloader(train_dataset, train_inputs, shuffle=True)
+    else:
+      # compiled models want every batch to be the same shape
+      train_dataloader = DataLoader(train_dataset, batch_size=BATCHSIZE, num_workers=N_WORKERS, drop_last=COMPILE_MODEL)
   else:
     train_dataset = None
     train_dataloader = None
 
-  val_dataset = dataset_class(val_seqs, val_perms, question=question, mainthread=should_speak)
-  val_dataloader = DataLoader(val_dataset, batch_size=BATCHSIZE, num_workers=N_WORKERS)
+  if not VIRTUAL_EVAL:
+    val_dataset = dataset_class(val_seqs, val_perms, question=question, mainthread=should_speak)
+    test_dataset = dataset_class(test_seqs, test_perms, question=question, mainthread=should_speak)
 
-  test_dataset = dataset_class(test_seqs, test_perms, question=question, mainthread=should_speak)
-  test_dataloader = DataLoader(test_dataset, batch_size=BATCHSIZE, num_workers=N_WORKERS)
+  if BUCKETED_BATCHES:
+    val_dataloader = bucketed_dataloader(val_dataset, val_seqs, shuffle=False)
+    test_dataloader = bucketed_dataloader(test_dataset, test_seqs, shuffle=False)
+  else:
+    val_dataloader = DataLoader(val_dataset, batch_size=BATCHSIZE, num_workers=N_WORKERS)
+    test_dataloader = DataLoader(test_dataset, batch_size=BATCHSIZE, num_workers=N_WORKERS)
 
   return (
      train_inputs, train_perms, train_dataloader, 
@@ -0,0 +1,67 @@
+from config import *
+from utilities import reshape_outputs
+from dataloading import bucketed_dataloader
+from torch.utils.data import DataLoader, Subset
+import torch.nn.functional as F
+import numpy as np
+import torch
+
+# validation during training
+# every process evaluates its own share of the rows and keeps running sums on the device
+# only the three sums get reduced at the end, so nothing big is sent between processes
+
+class Evaluator:
+    """
+        Evaluates a model on the validation set, or on a fixed random subset of it.
+        The rows are split between the processes without any padding,
+        so every row is counted exactly once.
+        sequences are the (shifted) input words, they're only needed for bucketed batches.
+    """
+
+    def __init__(self, accelerator, dataset, sequences, mode=EVAL_MODE, subset_size=EVAL_SUBSET_SIZE, seed=0):
+        self.accelerator = accelerator
+
+        indices = np.arange(len(dataset))
+
+        if mode == "subset":
+            # the same rows every time, so the numbers can be compared between evaluations
+            generator = np.random.default_rng(seed)
+            indices = np.sort(generator.choice(len(dataset), min(subset_size, len(dataset)), replace=False))
+        elif mode != "full":
+            raise Exception(f"Unknown evaluation mode {mode}")
+
+        # every process gets a block of consecutive rows, which virtual datasets can make in one go
+        indices = np.array_split(indices, accelerator.num_processes)[accelerator.process_index]
+        subset = Subset(dataset, indices)
+
+        if BUCKETED_BATCHES:
+            self.dataloader = bucketed_dataloader(subset, np.asarray(sequences)[indices], shuffle=False)
+        else:
+            self.dataloader = DataLoader(subset, batch_size=BATCHSIZE, num_workers=N_WORKERS)
+
+    def evaluate(self, model):
+        # returns the (loss, accuracy) over every validation token
+        accelerator = self.accelerator
+        was_training = model.training
+
+        model.eval()
+
+        # (loss, correct, count)
+        totals = torch.zeros(3, device=accelerator.device)
+
+        with torch.no_grad():
+            for inputs, targets in self.dataloader:
+                inputs, targets = inputs.to(accelerator.device), targets.to(accelerator.device)
+                outputs, targets = reshape_outputs(model(inputs), targets)
+
+                totals += torch.stack((
+                    F.cross_entropy(outputs.float(), targets, reduction="sum"),
+                    (outputs.argmax(dim=1) == targets).sum(),
+                    torch.tensor(targets.numel(), device=accelerator.device)
+                ))
+
+        model.train(was_training)
+
+        loss, correct, count = accelerator.reduce(totals, "sum").tolist()
+
+        return loss / count, correct / count
@@ -0,0 +1,190 @@
+from config import *
+from transformer import *
+from utilities import load_weights
+from dataloading import read_shard, find_shards, build_masked_rows
+from accelerate import Accelerator
+from torch.ao.quantization import quantize_dynamic
+import numpy as np
+import torch
+import copy
+import time
+import os
+
+# exports the model for running on cpus
+# writes frozen torchscript graphs of the forward pass, the input prefill and a single decode step
+# optionally with the linear layers quantized to int8, and optionally as onnx too
+# then compares them against the eager model on the test set
+
+# the graphs are traced with this batch size, but the batch size isn't baked in
+# the sequence lengths are, which is where the mask comes from
+EXPORT_BATCHSIZE = TEST_BATCHSIZE
+EXPORT_QUANTIZED = True
+EXPORT_ONNX = False
+REPORT_SIZE = 4096 # test sequences used for the report
+
+def trace(module, example):
+    # the mask and the weights become constants of the graph
+    with torch.no_grad():
+        traced = torch.jit.trace(module, example, check_trace=False)
+
+    return torch.jit.freeze(traced.eval())
+
+def export_graphs(model):
+    """
+        Traces the three graphs we need.
+        forward: full rows, same as training
+        prefill: puts the input into an empty cache
+        step: one new token for every row
+    """
+    B = EXPORT_BATCHSIZE
+    keys, values = empty_cache(B)
+
+    examples = {
+        "forward": (torch.zeros(B, CONTEXT_LENGTH, dtype=int),),
+        "prefill": (torch.zeros(B, INPUT_LENGTH, dtype=int), torch.tensor(0), keys, values),
+        "step": (torch.full((B, 1), START_PREDICTION_TOKEN, dtype=int), torch.tensor(INPUT_LENGTH), keys, values)
+    }
+
+    modules = {
+        "forward": model,
+        "prefill": CachedStep(model),
+        "step": CachedStep(model)
+    }
+
+    return {name: trace(modules[name], examples[name]) for name in modules}, modules, examples
+
+def export_onnx(modules, examples, directory):
+    try:
+        import onnx
+    except ImportError:
+        raise Exception("Exporting to onnx needs the onnx package")
+
+    names = {
+        "forward": (["tokens"], ["logits"]),
+        "prefill": (["tokens", "length", "keys", "values"], ["logits", "new_keys", "new_values"]),
+        "step": (["tokens", "length", "keys", "values"], ["logits", "new_keys", "new_values"])
+    }
+
+    for name in modules:
+        input_names, output_names = names[name]
+
+        torch.onnx.export(
+            modules[name], examples[name], f"{directory}/{name}.onnx",
+            input_names=input_names, output_names=output_names
+        )
+
+def generate_exported(graphs, sequences):
+    """
+        Greedy decoding with force_valid, the same as Transformer.generate_batch,
+        but using the exported prefill and step graphs.
+    """
+    results = []
+
+    for start in range(0, len(sequences), EXPORT_BATCHSIZE):
+        batch = np.asarray(sequences[start:start+EXPORT_BATCHSIZE], dtype=np.int64)
+        B = len(batch)
+
+        keys, values = empty_cache(B)
+
+        with torch.no_grad():
+            _, keys, values = graphs["prefill"](torch.from_numpy(batch), torch.tensor(0), keys, values)
+
+            tokens = torch.full((B, 1), START_PREDICTION_TOKEN, dtype=int)
+            permutations = torch.empty(B, MAX_GROUP_SIZE, dtype=int)
+            allowed = allowed_tokens(B, "cpu")
+
+            for x in range(MAX_GROUP_SIZE):
+                if x == MAX_GROUP_SIZE - 1:
+                    chosen = allowed.int().argmax(dim=-1)
+                else:
+                    logits, keys, values = graphs["step"](tokens, torch.tensor(INPUT_LENGTH + x), keys, values)
+                    chosen = logits.masked_fill(~allowed, float('-inf')).argmax(dim=-1)
+
+                permutations[:, x] = chosen
+                allowed[torch.arange(B), chosen] = False
+                tokens = chosen.unsqueeze(1)
+
+        results.append(permutations.numpy() - num_trans)
+
+    return np.concatenate(results)
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+
+    return result, time.perf_counter() - start
+
+def report(model, variants, test_seqs, test_perms):
+    accelerator = Accelerator(cpu=True)
+
+    eager_perms, eager_time = timed(lambda: np.concatenate([
+        model.generate_batch(test_seqs[start:start+EXPORT_BATCHSIZE], accelerator, force_valid=True)
+        for start in range(0, len(test_seqs), EXPORT_BATCHSIZE)
+    ]))
+
+    # also check the forward graphs on the training style rows
+    rows, _ = build_masked_rows(test_seqs[:EXPORT_BATCHSIZE], test_perms[:EXPORT_BATCHSIZE])
+
+    with torch.no_grad():
+        eager_logits = model(rows)
+
+    print(f"{'model':<20}{'accuracy':>10}{'agreement':>11}{'max logit diff':>16}{'seconds':>10}{'speedup':>9}")
+    print(f"{'eager':<20}{(eager_perms == test_perms).all(axis=1).mean():>10.4f}{1:>11.4f}{0:>16.2e}{eager_time:>10.2f}{1:>9.2f}")
+
+    for name, graphs in variants.items():
+        perms, elapsed = timed(lambda: generate_exported(graphs, test_seqs))
+
+        with torch.no_grad():
+            logit_diff = (graphs["forward"](rows) - eager_logits).abs().max().item()
+
+        accuracy = (perms == test_perms).all(axis=1).mean()
+        agreement = (perms == eager_perms).all(axis=1).mean()
+
+        print(f"{name:<20}{accuracy:>10.4f}{agreement:>11.4f}{logit_diff:>16.2e}{elapsed:>10.2f}{eager_time / elapsed:>9.2f}")
+
+def export():
+    if not MASKED_MODEL or REVERSE_PROBLEM or LEGACY_ARCHITECTURE:
+        raise Exception("Only masked models with the current architecture can be exported")
+
+    if BUCKETED_BATCHES:
+        raise Exception("The exported graphs have static shapes, so they can't trim the input")
+
+    save_directory = f"{PATH}/model/{MODELNAME}"
+    file_path = f"{save_directory}/model.safetensors"
+
+    if not os.path.isfile(file_path):
+        raise Exception(f"Couldn't find a model at {file_path}")
+
+    model = load_weights(Transformer(), file_path)
+    model.eval()
+
+    export_directory = f"{save_directory}/export"
+    os.makedirs(export_directory, exist_ok=True)
+
+    print("Exporting the model...")
+    graphs, modules, examples = export_graphs(model)
+    variants = {"torchscript": graphs}
+
+    if EXPORT_QUANTIZED:
+        print("Quantizing the model...")
+        quantized = quantize_dynamic(copy.deepcopy(model), {nn.Linear}, dtype=torch.qint8)
+        variants["torchscript int8"], _, _ = export_graphs(quantized)
+
+    for variant, variant_graphs in variants.items():
+        suffix = "_int8" if variant.endswith("int8") else ""
+
+        for name, graph in variant_graphs.items():
+            torch.jit.save(graph, f"{export_directory}/{name}{suffix}.pt")
+
+    if EXPORT_ONNX:
+        print("Exporting to onnx...")
+        export_onnx(modules, examples, export_directory)
+
+    print("Loading test data...")
+    test_seqs, test_perms = read_shard(find_shards("test")[0])
+    test_seqs, test_perms = np.asarray(test_seqs[:REPORT_SIZE]), np.asarray(test_perms[:REPORT_SIZE])
+
+    report(model, variants, test_seqs, test_perms)
+
+if __name__ == "__main__":
+    export()
@@ -0,0 +1,283 @@
+from config import *
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+import numpy as np
+
+# makes training data on the fly
+# this is the same as running fast-data-gen with --scaling, but a whole batch of words at a time
+# so the dataloader workers can keep up with training without touching the disk
+# the validation and test sets can be made the same way, from a seed instead of a file
+
+MIN_WINDOW_SIZE = 3
+
+def check_settings():
+  # the same rules fast-data-gen checks
+  if INPUT_TYPE not in ["elementary", "general"]:
+    raise Exception("Only elementary and general words can be generated")
+
+  if WINDOW and RELABEL:
+    raise Exception("You can't use window and relabelling at the same time")
+
+  if RELABEL and INPUT_TYPE == "elementary":
+    raise Exception("You can't use relabelling with elementary transpositions")
+
+  if WINDOW and PARTITIONED_WINDOWS:
+    if WINDOW_COUNT is not None and WINDOW_COUNT > 1:
+      raise Exception("Cannot have WINDOW_COUNT > 1 while partitioned windows are enabled")
+
+    if INPUT_TYPE != "elementary":
+      raise Exception("Only elementary transpositions support partitioned windows")
+
+    if ACTUAL_GROUP_SIZE < MIN_WINDOW_SIZE:
+      raise Exception(f"Partitioned windows need a group size of at least {MIN_WINDOW_SIZE}")
+
+  if WINDOW and WINDOW_COUNT is not None and WINDOW_COUNT > 1:
+    if ACTUAL_GROUP_SIZE % WINDOW_COUNT != 0:
+      raise Exception("Window count must divide the group size")
+
+    if INPUT_TYPE != "elementary":
+      raise Exception("Only elementary transpositions support WINDOW_COUNT > 1")
+
+def partitions(total, smallest=MIN_WINDOW_SIZE):
+  # every way of writing total as a sum of parts that are at least smallest
+  if total == 0:
+    return [[]]
+
+  return [
+    [part] + rest
+    for part in range(smallest, total + 1)
+    for rest in partitions(total - part, part)
+  ]
+
+def window_sizes():
+  """
+    The possible window sizes for a word, one row per choice, padded with 0.
+    fast-data-gen samples partitions uniformly (with Fristedt's method),
+    so we can just list them all and pick one.
+  """
+  if PARTITIONED_WINDOWS:
+    choices = partitions(ACTUAL_GROUP_SIZE)
+  else:
+    count = WINDOW_COUNT or 1
+    choices = [[ACTUAL_GROUP_SIZE // count] * count]
+
+  sizes = np.zeros((len(choices), max(len(choice) for choice in choices)), dtype=np.int64)
+
+  for index, choice in enumerate(choices):
+    sizes[index, :len(choice)] = choice
+
+  return sizes, np.array([len(choice) for choice in choices])
+
+def draws_per_word(length=MAX_TRANS_NUMBER):
+  # every word uses the same amount of random numbers, whatever the settings pick
+  # (rounded up to a whole philox block), so a word only depends on its own numbers
+  windows = window_sizes()[0].shape[1] if WINDOW else 0
+  draws = 2 * length + 1 + windows + MAX_GROUP_SIZE
+
+  return -(-draws // 4) * 4
+
+def scale(uniforms, high):
+  # numbers in [0, 1) to integers in [0, high)
+  return (uniforms * high).astype(np.int64)
+
+def make_words(uniforms, length=MAX_TRANS_NUMBER):
+  """
+    Random words in max group size tokens, as an (amount, length) array.
+    Row i of uniforms (draws_per_word numbers in [0, 1)) makes word i,
+    with its own windows (or relabelling), like fast-data-gen.
+  """
+  amount = len(uniforms)
+  rows = np.arange(amount)[:, np.newaxis]
+
+  letters = uniforms[:, :length]
+  picks = uniforms[:, length:2*length]
+  extra = uniforms[:, 2*length:]
+
+  if INPUT_TYPE == "elementary":
+    words = scale(letters, ACTUAL_GROUP_SIZE)
+  else:
+    words = scale(letters, ACTUAL_GROUP_SIZE**2)
+
+    # write the transpositions in the max group size order
+    words = words % ACTUAL_GROUP_SIZE + MAX_GROUP_SIZE * (words // ACTUAL_GROUP_SIZE)
+
+  if WINDOW:
+    all_sizes, all_counts = window_sizes()
+    windows = all_sizes.shape[1]
+
+    choice = scale(extra[:, 0], len(all_sizes))
+    sizes, counts = all_sizes[choice], all_counts[choice]
+
+    # every window has its own shift and every letter picks one of the word's windows
+    shifts = scale(extra[:, 1:1+windows], MAX_GROUP_SIZE - sizes + 1)
+    picked = scale(picks, counts[:, np.newaxis])
+
+    if INPUT_TYPE == "elementary":
+      words = shifts[rows, picked] + words % sizes[rows, picked]
+    else:
+      words = words + shifts[rows, picked] * (MAX_GROUP_SIZE + 1)
+
+  if RELABEL:
+    relabelling = extra[:, 1:1+MAX_GROUP_SIZE].argsort(axis=1)
+    words = relabelling[rows, words // MAX_GROUP_SIZE] * MAX_GROUP_SIZE + relabelling[rows, words % MAX_GROUP_SIZE]
+
+  return words
+
+def generate_words(amount, generator, length=MAX_TRANS_NUMBER):
+  return make_words(generator.random((amount, draws_per_word(length))), length)
+
+def philox_uniforms(seed, indices, draws):
+  """
+    The random numbers for words indices, made with philox keyed by seed.
+    Every philox counter gives 4 numbers, so word i starts at counter i * draws / 4.
+    Each run of consecutive indices is made in one go.
+  """
+  indices = np.asarray(indices, dtype=np.int64)
+  runs = np.split(indices, np.flatnonzero(np.diff(indices) != 1) + 1)
+
+  raw = np.concatenate([np.empty(0, dtype=np.uint64)] + [
+    np.random.Philox(key=seed, counter=int(run[0]) * draws // 4).random_raw(len(run) * draws)
+    for run in runs if len(run)
+  ])
+
+  # the top 53 bits make a double in [0, 1)
+  return (raw >> np.uint64(11)).reshape(len(indices), draws) * 2.0**-53
+
+def compute_permutations(words):
+  # applies every word's swaps at once, one letter at a time
+  amount, length = words.shape
+  rows = np.arange(amount)
+
+  perms = np.tile(np.arange(MAX_GROUP_SIZE), (amount, 1))
+
+  if INPUT_TYPE == "elementary":
+    first, second = words, words - 1
+  else:
+    first, second = words // MAX_GROUP_SIZE, words % MAX_GROUP_SIZE
+
+  for position in range(length):
+    x, y = first[:, position], second[:, position]
+
+    # 0 is the identity, so those rows keep what they have
+    swap = words[:, position] != 0
+
+    at_x, at_y = perms[rows, x], perms[rows, y]
+    perms[rows, x] = np.where(swap, at_y, at_x)
+    perms[rows, y] = np.where(swap, at_x, at_y)
+
+  return perms
+
+class GeneratedDataset(IterableDataset):
+    """
+        An endless supply of fresh training data.
+        Every (process, dataloader worker) pair has its own random stream,
+        seeded with (seed, process, worker, epoch), so a run can be repeated.
+        Yields whole batches built with dataset_class.build_rows,
+        so use it with DataLoader(batch_size=None).
+    """
+
+    def __init__(
+            self,
+            dataset_class,
+            process_index=0,
+            num_processes=1,
+            batch_size=BATCHSIZE,
+            epoch_size=ONLINE_EPOCH_SIZE,
+            seed=ONLINE_SEED
+        ):
+        if not hasattr(dataset_class, "build_rows"):
+            raise Exception(f"{dataset_class.__name__} does not support generated data")
+
+        check_settings()
+
+        self.build_rows = dataset_class.build_rows
+        self.process_index = process_index
+        self.num_processes = num_processes
+        self.batch_size = batch_size
+        self.epoch_size = epoch_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        # a new epoch gets new data
+        self.epoch = epoch
+
+    def __len__(self):
+        # number of batches this process will see, they're all full
+        return max(1, self.epoch_size // (self.num_processes * self.batch_size))
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker = worker_info.id if worker_info is not None else 0
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+
+        generator = np.random.default_rng([self.seed, self.process_index, worker, self.epoch])
+
+        # the dataloader takes batches from the workers in turn
+        for _ in range(worker, len(self), num_workers):
+            words = generate_words(self.batch_size, generator)
+
+            yield self.build_rows(words, compute_permutations(words))
+
+class VirtualDataset(Dataset):
+    """
+        A dataset that isn't stored anywhere.
+        Word i is made from philox (a counter based random number generator)
+        with key seed and counter i, so any rows can be made again whenever they're needed,
+        in any order and on any process. Use a different seed for every split.
+        sequences and permutations work like arrays, but only make the rows you slice.
+    """
+
+    def __init__(self, dataset_class, size, seed, length=MAX_TRANS_NUMBER):
+        if not hasattr(dataset_class, "build_rows"):
+            raise Exception(f"{dataset_class.__name__} does not support generated data")
+
+        check_settings()
+
+        self.build_rows = dataset_class.build_rows
+        self.size = size
+        self.seed = seed
+        self.length = length
+        self.draws = draws_per_word(length)
+
+        self.sequences = VirtualColumn(self, permutations=False)
+        self.permutations = VirtualColumn(self, permutations=True)
+
+    def __len__(self):
+        return self.size
+
+    def words(self, indices):
+        return make_words(philox_uniforms(self.seed, indices, self.draws), self.length)
+
+    def __getitems__(self, indices):
+        # the dataloader asks for a whole batch at once, so the batch is made together
+        words = self.words(indices)
+        data, targets = self.build_rows(words, compute_permutations(words))
+
+        return list(zip(data, targets))
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(f"Index {index} is out of range")
+
+        return self.__getitems__([index])[0]
+
+class VirtualColumn:
+    # the words or permutations of a VirtualDataset
+    def __init__(self, dataset, permutations):
+        self.dataset = dataset
+        self.permutations = permutations
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key+1 or None][0]
+
+        words = self.dataset.words(np.arange(*key.indices(len(self))))
+
+        return compute_permutations(words) if self.permutations else words
+
+    def __iter__(self):
+        for start in range(0, len(self), BATCHSIZE):
+            yield from self[start:start+BATCHSIZE]
@@ -0,0 +1,72 @@
+from config import *
+from dataloading import read_shard, find_shards
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import http.client
+import json
+import time
+
+# hammers a running server.py with test sequences
+# and reports the throughput and latency
+
+CLIENTS = 32 # requests in flight at once
+REQUESTS = 2000
+SEQUENCES_PER_REQUEST = 1
+
+def run_client(sequences, requests, seed):
+    generator = np.random.default_rng(seed)
+
+    # one connection per client, kept open like a real caller would
+    connection = http.client.HTTPConnection(SERVER_HOST, SERVER_PORT)
+    latencies = []
+
+    for _ in range(requests):
+        rows = generator.integers(len(sequences), size=SEQUENCES_PER_REQUEST)
+        body = json.dumps({"sequences": sequences[rows].tolist(), "force_valid": True})
+
+        start = time.perf_counter()
+
+        connection.request("POST", "/generate", body, {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        reply = response.read()
+
+        latencies.append(time.perf_counter() - start)
+
+        if response.status != 200:
+            raise Exception(f"Request failed with status {response.status}: {reply}")
+
+    connection.close()
+
+    return latencies
+
+def load_test():
+    test_seqs, test_perms = read_shard(find_shards("test")[0])
+    test_seqs = np.asarray(test_seqs)
+
+    # split the requests between the clients as evenly as possible
+    per_client = [REQUESTS // CLIENTS + (client < REQUESTS % CLIENTS) for client in range(CLIENTS)]
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(CLIENTS) as pool:
+        results = list(pool.map(run_client, [test_seqs]*CLIENTS, per_client, range(CLIENTS)))
+
+    elapsed = time.perf_counter() - start
+
+    latencies = np.concatenate(results) * 1000
+
+    print(f"Clients: {CLIENTS}, requests: {REQUESTS}, sequences per request: {SEQUENCES_PER_REQUEST}")
+    print(f"Throughput: {REQUESTS / elapsed:.1f} requests/s, {REQUESTS * SEQUENCES_PER_REQUEST / elapsed:.1f} sequences/s")
+    print(f"Latency p50: {np.percentile(latencies, 50):.1f}ms, p99: {np.percentile(latencies, 99):.1f}ms")
+
+    # parallel decoding reports how many passes it's been taking
+    connection = http.client.HTTPConnection(SERVER_HOST, SERVER_PORT)
+    connection.request("GET", "/health")
+    health = json.loads(connection.getresponse().read())
+    connection.close()
+
+    if "iterations" in health:
+        print(f"Parallel decoding passes, mean: {health['iterations']['mean']}, counts: {health['iterations']['counts']}")
+
+if __name__ == "__main__":
+    load_test()
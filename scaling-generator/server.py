@@ -0,0 +1,229 @@
+from config import *
+from transformer import *
+from utilities import load_weights
+from accelerate import Accelerator
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import Future
+import numpy as np
+import threading
+import queue
+import json
+import time
+import os
+
+# a long running server that keeps the model loaded
+# POST {"sequences": [[...], ...], "force_valid": true} to /generate
+# and get back {"permutations": [[...], ...]}
+# requests that arrive at about the same time get generated as one batch
+# GET /health also says how many passes parallel decoding has been taking
+
+def pad_sequences(sequences):
+    """
+        Turns a list of words into an input array.
+        Words are padded with 0 at the end, the same as the generated data.
+    """
+    padded = np.zeros((len(sequences), INPUT_LENGTH), dtype=np.int64)
+
+    for pos, sequence in enumerate(sequences):
+        if len(sequence) > INPUT_LENGTH:
+            raise ValueError(f"Sequences can have at most {INPUT_LENGTH} tokens")
+
+        padded[pos, :len(sequence)] = sequence
+
+    if padded.min(initial=0) < 0 or padded.max(initial=0) >= num_trans:
+        raise ValueError(f"Tokens must be between 0 and {num_trans - 1}")
+
+    return padded
+
+class Batcher:
+    """
+        Collects requests from any number of threads and generates them together.
+        Waits for the first request, then for up to max_wait seconds for more,
+        or until there are max_batch sequences.
+        decoding works the same as DECODING, beam search is always valid.
+    """
+
+    def __init__(self, model, accelerator, max_batch=SERVER_MAX_BATCH, max_wait=SERVER_MAX_WAIT, decoding=DECODING):
+        if decoding not in ["greedy", "beam", "parallel"]:
+            raise Exception(f"Unknown decoding {decoding}")
+
+        self.model = model
+        self.accelerator = accelerator
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.decoding = decoding
+
+        # how many sequences needed each number of parallel decoding passes
+        self.iteration_counts = np.zeros(MAX_GROUP_SIZE + 1, dtype=np.int64)
+
+        self.requests = queue.Queue()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, sequences, force_valid=True):
+        future = Future()
+        self.requests.put((sequences, force_valid, future))
+
+        return future
+
+    def collect(self):
+        batch = [self.requests.get()]
+        rows = len(batch[0][0])
+
+        deadline = time.monotonic() + self.max_wait
+
+        while rows < self.max_batch:
+            timeout = deadline - time.monotonic()
+
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+            rows += len(batch[-1][0])
+
+        return batch
+
+    def generate_chunk(self, sequences, force_valid):
+        if self.decoding == "beam":
+            return self.model.generate_beam(sequences, self.accelerator)[0]
+
+        if self.decoding == "parallel":
+            permutations, iterations = self.model.generate_parallel(sequences, self.accelerator, force_valid=force_valid)
+            np.add.at(self.iteration_counts, iterations, 1)
+
+            return permutations
+
+        return self.model.generate_batch(sequences, self.accelerator, force_valid=force_valid)
+
+    def generate(self, sequences, force_valid):
+        # a single big request can still be bigger than a batch
+        return np.concatenate([
+            self.generate_chunk(sequences[start:start+self.max_batch], force_valid)
+            for start in range(0, len(sequences), self.max_batch)
+        ])
+
+    def iteration_stats(self):
+        counts = self.iteration_counts.copy()
+        total = counts.sum()
+
+        return {
+            "mean": float((counts * np.arange(len(counts))).sum() / total) if total else None,
+            "counts": {str(passes): int(count) for passes, count in enumerate(counts) if count}
+        }
+
+    def run(self):
+        while True:
+            batch = self.collect()
+
+            for force_valid in [False, True]:
+                group = [request for request in batch if request[1] == force_valid]
+
+                if not group:
+                    continue
+
+                try:
+                    permutations = self.generate(np.concatenate([request[0] for request in group]), force_valid)
+                except Exception as e:
+                    for _, _, future in group:
+                        future.set_exception(e)
+
+                    continue
+
+                # hand everyone back their own rows
+                start = 0
+                for sequences, _, future in group:
+                    future.set_result(permutations[start:start+len(sequences)])
+                    start += len(sequences)
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # keep connections open between requests
+    protocol_version = "HTTP/1.1"
+
+    def reply(self, status, body):
+        body = json.dumps(body).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.reply(404, {"error": "Not found"})
+            return
+
+        health = {"status": "ok", "model": MODELNAME, "decoding": self.server.batcher.decoding}
+
+        if self.server.batcher.decoding == "parallel":
+            health["iterations"] = self.server.batcher.iteration_stats()
+
+        self.reply(200, health)
+
+    def do_POST(self):
+        if self.path != "/generate":
+            self.reply(404, {"error": "Not found"})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            sequences = pad_sequences(request["sequences"])
+            force_valid = bool(request.get("force_valid", True))
+        except (KeyError, TypeError, ValueError) as e:
+            self.reply(400, {"error": str(e)})
+            return
+
+        if len(sequences) == 0:
+            self.reply(200, {"permutations": []})
+            return
+
+        try:
+            permutations = self.server.batcher.submit(sequences, force_valid).result()
+        except Exception as e:
+            self.reply(500, {"error": str(e)})
+            return
+
+        self.reply(200, {"permutations": permutations.tolist()})
+
+    def log_message(self, format, *args):
+        # logging every request would slow everything down
+        pass
+
+def serve():
+    accelerator = Accelerator()
+
+    if not MASKED_MODEL:
+        raise Exception("The server needs a masked model")
+
+    # load the model once
+    model = Transformer()
+
+    file_path = f"{PATH}/model/{MODELNAME}/model.safetensors"
+
+    if not os.path.isfile(file_path):
+        raise Exception(f"Couldn't find a model at {file_path}")
+
+    model = load_weights(model, file_path)
+    model = model.to(accelerator.device)
+    model.eval()
+
+    server = ThreadingHTTPServer((SERVER_HOST, SERVER_PORT), RequestHandler)
+    server.daemon_threads = True
+    server.batcher = Batcher(model, accelerator)
+
+    print(f"Serving {MODELNAME} on http://{SERVER_HOST}:{SERVER_PORT} with {DECODING} decoding")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,213 @@
+from config import *
+from utilities import convert_perm_to_tokens
+from dataloading import build_masked_rows, build_reversed_rows, MaskedDataset, ReversedDataset, SimpleDataset, StreamingDataset, read_shard
+from torch.utils.data import DataLoader
+from convert_data import convert_array
+from contextlib import contextmanager
+from torch import tensor
+import numpy as np
+import tempfile
+import torch
+import utilities
+import dataloading
+import convert_data
+
+# checks that the vectorized row builders make exactly what the old per row loops made
+# run with python -m pytest test_dataloading.py (or just python test_dataloading.py)
+
+def old_masked_rows(sequences, permutations):
+  # the loop MaskedDataset used to run
+  data = []
+  targets = []
+
+  for sequence, permutation in zip(sequences, permutations):
+    shifted_perm = convert_perm_to_tokens(permutation)
+
+    data.append(list(sequence) + [START_PREDICTION_TOKEN] + list(shifted_perm)[:-1])
+    targets.append(shifted_perm)
+
+  return tensor(data, dtype=int), tensor(targets, dtype=int)
+
+def old_reversed_rows(sequences, permutations):
+  # the loop ReversedDataset used to run
+  data = []
+  targets = []
+
+  for sequence, permutation in zip(sequences, permutations):
+    shifted_perm = convert_perm_to_tokens(permutation)
+
+    data.append(list(shifted_perm) + [START_PREDICTION_TOKEN] + list(sequence)[:-1])
+    targets.append(sequence)
+
+  return tensor(np.array(data), dtype=int), tensor(np.array(targets), dtype=int)
+
+def random_pairs(amount, dtype, seed):
+  generator = np.random.default_rng(seed)
+
+  sequences = generator.integers(0, num_trans, size=(amount, INPUT_LENGTH)).astype(dtype)
+  permutations = generator.random((amount, MAX_GROUP_SIZE)).argsort(axis=1).astype(dtype)
+
+  return sequences, permutations
+
+def assert_identical(new, old):
+  for new_tensor, old_tensor in zip(new, old):
+    assert new_tensor.dtype == old_tensor.dtype
+    assert new_tensor.shape == old_tensor.shape
+    assert torch.equal(new_tensor, old_tensor)
+
+def test_masked_rows():
+  # uint8 is what the binary shards are stored as
+  for seed, dtype in enumerate([np.int64, np.uint8]):
+    sequences, permutations = random_pairs(200, dtype, seed)
+
+    assert_identical(build_masked_rows(sequences, permutations), old_masked_rows(sequences, permutations))
+
+def test_reversed_rows():
+  for seed, dtype in enumerate([np.int64, np.uint8]):
+    sequences, permutations = random_pairs(200, dtype, seed)
+
+    assert_identical(build_reversed_rows(sequences, permutations), old_reversed_rows(sequences, permutations))
+
+def test_datasets():
+  sequences, permutations = random_pairs(50, np.int64, 2)
+
+  masked = MaskedDataset(sequences, permutations, mainthread=False)
+  assert_identical((masked.data, masked.targets), old_masked_rows(sequences, permutations))
+
+  reversed_dataset = ReversedDataset(sequences, permutations, mainthread=False)
+  assert_identical((reversed_dataset.data, reversed_dataset.targets), old_reversed_rows(sequences, permutations))
+
+@contextmanager
+def patched(settings):
+  # sets (module, name, value) for as long as the with block runs
+  old_values = [getattr(module, name) for module, name, _ in settings]
+
+  for module, name, value in settings:
+    setattr(module, name, value)
+
+  try:
+    yield
+  finally:
+    for (module, name, _), value in zip(settings, old_values):
+      setattr(module, name, value)
+
+def data_in(directory):
+  return patched([
+    (dataloading, "PATH", directory),
+    (dataloading, "DATA", "/"),
+    (convert_data, "PATH", directory),
+    (convert_data, "DATA", "/")
+  ])
+
+def general_data():
+  # pretends the config is set up for an unmasked model with general inputs
+  general_trans = MAX_GROUP_SIZE**2
+
+  return patched([
+    (utilities, "num_trans", general_trans),
+    (dataloading, "NULL_TOKEN", general_trans + MAX_GROUP_SIZE),
+    (dataloading, "START_PREDICTION_TOKEN", general_trans + MAX_GROUP_SIZE + 1),
+    # SimpleDataset is for unmasked models, which have one more token
+    (dataloading, "CONTEXT_LENGTH", INPUT_LENGTH + MAX_GROUP_SIZE + 1)
+  ])
+
+def test_general_uint8_shard():
+  # general words go up to MAX_GROUP_SIZE**2 - 1, which still fits in a uint8
+  generator = np.random.default_rng(3)
+
+  sequences = generator.integers(0, MAX_GROUP_SIZE**2, size=(20, INPUT_LENGTH))
+  permutations = generator.random((20, MAX_GROUP_SIZE)).argsort(axis=1)
+
+  with tempfile.TemporaryDirectory() as directory, data_in(directory), general_data():
+    np.savetxt(f"{directory}/val_data.csv", sequences, delimiter=",", fmt="%d")
+    np.savetxt(f"{directory}/val_data_perms.csv", permutations, delimiter=",", fmt="%d")
+
+    shard = {
+      "inputs": convert_array({"file": "val_data.csv"}),
+      "perms": convert_array({"file": "val_data_perms.csv"})
+    }
+
+    assert shard["inputs"]["dtype"] == "uint8"
+    assert shard["perms"]["dtype"] == "uint8"
+
+    shard_sequences, shard_permutations = read_shard(shard)
+
+    assert utilities.convert_perm_to_tokens(shard_permutations[0]) == list(permutations[0] + MAX_GROUP_SIZE**2)
+
+    from_shard = SimpleDataset(shard_sequences, shard_permutations)
+    from_csv = SimpleDataset(sequences, permutations)
+
+    assert_identical((from_shard.data, from_shard.targets), (from_csv.data, from_csv.targets))
+    assert from_shard.targets.max() >= MAX_GROUP_SIZE**2
+
+def write_shards(directory, sizes):
+  # binary shards where the first tokens of every word spell out its row number
+  shards = []
+  row = 0
+
+  for index, size in enumerate(sizes):
+    rows = np.arange(row, row + size)
+    sequences = np.zeros((size, INPUT_LENGTH), dtype=np.uint8)
+
+    for digit in range(3):
+      sequences[:, digit] = rows // num_trans**digit % num_trans
+
+    permutations = np.tile(np.arange(MAX_GROUP_SIZE, dtype=np.uint8), (size, 1))
+
+    shards.append({})
+
+    for half, array in [("inputs", sequences), ("perms", permutations)]:
+      array.tofile(f"{directory}/train_data{index}_{half}.bin")
+      shards[-1][half] = {"file": f"train_data{index}_{half}.bin", "shape": list(array.shape), "dtype": "uint8"}
+
+    row += size
+
+  return shards
+
+def streamed_rows(dataset, num_workers):
+  batches = list(DataLoader(dataset, batch_size=None, num_workers=num_workers))
+  rows = [data[:, :3].numpy() @ num_trans**np.arange(3) for data, _ in batches]
+
+  return len(batches), np.concatenate(rows) if rows else np.array([], dtype=int)
+
+def test_streaming_covers_every_row():
+  with tempfile.TemporaryDirectory() as directory, data_in(directory):
+    shards = write_shards(directory, [70, 133])
+    total = 203
+
+    for drop_last in [False, True]:
+      for num_processes in [1, 3, 4]:
+        datasets = [
+          StreamingDataset(
+            shards, process_index=process, num_processes=num_processes,
+            batch_size=16, chunk_size=10, buffer_size=40, drop_last=drop_last
+          )
+          for process in range(num_processes)
+        ]
+
+        for num_workers in [0, 2, 3]:
+          seen = []
+
+          for dataset in datasets:
+            count, rows = streamed_rows(dataset, num_workers)
+
+            # the same for every process, whatever the number of workers
+            assert count == len(dataset) == len(datasets[0])
+            seen.append(rows)
+
+          seen = np.concatenate(seen)
+
+          if drop_last:
+            assert len(seen) == num_processes * (len(datasets[0]) * 16)
+          else:
+            # every row, plus the first one again for processes that were one short
+            assert np.array_equal(np.unique(seen), np.arange(total))
+            assert len(seen) == num_processes * -(-total // num_processes)
+
+if __name__ == "__main__":
+  test_masked_rows()
+  test_reversed_rows()
+  test_datasets()
+  test_general_uint8_shard()
+  test_streaming_covers_every_row()
+  print("All good")
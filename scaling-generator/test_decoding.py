@@ -0,0 +1,107 @@
+from config import *
+from transformer import Transformer, MultiHeadAttention, FusedMultiHeadAttention
+from dataloading import MaskedDataset, trim_collate
+from utilities import ZeroShifter
+from accelerate import Accelerator
+from contextlib import contextmanager
+import numpy as np
+import torch
+import transformer
+
+# checks that parallel (jacobi) decoding makes exactly what greedy decoding makes
+# and that with bucketed batches a word's output doesn't depend on the rest of its batch
+# run with python -m pytest test_decoding.py (or just python test_decoding.py)
+
+def random_model(seed):
+  torch.manual_seed(seed)
+
+  return Transformer().eval()
+
+def random_sequences(amount, seed):
+  generator = np.random.default_rng(seed)
+
+  return generator.integers(0, num_trans, size=(amount, INPUT_LENGTH))
+
+def test_parallel_matches_greedy():
+  accelerator = Accelerator(cpu=True)
+
+  for seed, force_valid in enumerate([True, False]):
+    model = random_model(seed)
+    sequences = random_sequences(16, seed)
+
+    greedy = model.generate_batch(sequences, accelerator, force_valid=force_valid)
+    parallel, iterations = model.generate_parallel(sequences, accelerator, force_valid=force_valid)
+
+    assert np.array_equal(parallel, greedy)
+    assert ((1 <= iterations) & (iterations <= MAX_GROUP_SIZE)).all()
+
+def test_parallel_with_a_guess():
+  accelerator = Accelerator(cpu=True)
+
+  model = random_model(2)
+  sequences = random_sequences(16, 2)
+
+  greedy = model.generate_batch(sequences, accelerator, force_valid=True)
+
+  # starting from the answer only needs one pass to check it
+  parallel, iterations = model.generate_parallel(sequences, accelerator, force_valid=True, initial_guess=greedy)
+
+  assert np.array_equal(parallel, greedy)
+  assert (iterations == 1).all()
+
+@contextmanager
+def bucketed(attention):
+  # turns on bucketed batches and picks the attention, just for the model
+  old_values = transformer.BUCKETED_BATCHES, transformer.Attention
+  transformer.BUCKETED_BATCHES, transformer.Attention = True, attention
+
+  try:
+    yield
+  finally:
+    transformer.BUCKETED_BATCHES, transformer.Attention = old_values
+
+def words_of_length(lengths, seed):
+  # words with their zeroes already moved to the end, like load_data does
+  generator = np.random.default_rng(seed)
+  sequences = generator.integers(1, num_trans, size=(len(lengths), INPUT_LENGTH))
+
+  for row, length in enumerate(lengths):
+    sequences[row, length:] = 0
+
+  return ZeroShifter().transform(sequences), generator.random((len(lengths), MAX_GROUP_SIZE)).argsort(axis=1)
+
+def test_bucketed_rows_ignore_batchmates():
+  accelerator = Accelerator(cpu=True)
+
+  # a short word, and longer words that make the batch longer
+  sequences, permutations = words_of_length([5, 0, 40, INPUT_LENGTH], 4)
+  dataset = MaskedDataset(sequences, permutations, mainthread=False)
+
+  for seed, attention in enumerate([MultiHeadAttention, FusedMultiHeadAttention]):
+    with bucketed(attention):
+      model = random_model(seed)
+
+      for row in range(2):
+        alone, _ = trim_collate([dataset[row]])
+        batched, _ = trim_collate([dataset[row]] + [dataset[other] for other in range(2, 4)])
+
+        assert alone.shape[1] < batched.shape[1]
+        assert torch.allclose(model(alone)[0], model(batched)[0], atol=1e-5)
+
+        # the same goes for generating, which trims the input by itself
+        greedy = model.generate_batch(sequences[row:row+1], accelerator, force_valid=True)
+        greedy_batched = model.generate_batch(sequences[[row, 2, 3]], accelerator, force_valid=True)
+
+        assert np.array_equal(greedy[0], greedy_batched[0])
+
+        beam, score = model.generate_beam(sequences[row:row+1], accelerator, beam_width=3)
+        beam_batched, score_batched = model.generate_beam(sequences[[row, 2, 3]], accelerator, beam_width=3)
+
+        assert np.array_equal(beam[0], beam_batched[0])
+        assert np.isclose(score[0], score_batched[0], atol=1e-4)
+
+if __name__ == "__main__":
+  test_parallel_matches_greedy()
+  test_parallel_with_a_guess()
+  test_bucketed_rows_ignore_batchmates()
+  print("All good")
@@ -3,9 +3,13 @@ from config import *
 from dataloading import *
 from transformer import *
 from tqdm import tqdm
-from accelerate import load_checkpoint_and_dispatch, Accelerator
+from accelerate import Accelerator
+import time
 
 def test():
+    if DECODING not in ["greedy", "beam", "parallel"]:
+        raise Exception(f"Unknown decoding {DECODING}")
+
     accelerator = Accelerator()
 
     should_talk = accelerator.is_main_process
@@ -28,7 +32,7 @@ def test():
     if os.path.isfile(file_path):
         if should_talk:
             print("Loaded the model!")
-        model = load_checkpoint_and_dispatch(model, file_path)
+        model = load_weights(model, file_path)
     elif should_talk:
         print("Failed to load the model, defaulting to untrained model")
 
@@ -50,21 +54,64 @@ def test():
         print("Free probability:", free_wins/len(test_perms))
 
     # test for all sequences
+    # a whole batch of sequences is generated at once
     results = []
+    correct = 0
+
+    unwrapped_model = model if hasattr(model, "generate_batch") else model.module
+
+    # every batch has the same shape, so the decode step only gets compiled once
+    if COMPILE_MODEL and DECODING == "greedy":
+        decoder = StaticDecoder(unwrapped_model, TEST_BATCHSIZE)
+    else:
+        decoder = unwrapped_model
+
+    # the first batch includes compiling, so time it separately
+    batch_times = []
+
+    # how many passes parallel decoding needed for each sequence
+    iterations = []
+
+    with tqdm(total=len(test_perms), desc="Testing", disable=not should_talk) as pbar:
+        for start in range(0, len(test_perms), TEST_BATCHSIZE):
+            seqs = test_seqs[start:start+TEST_BATCHSIZE]
+            real_perms = test_perms[start:start+TEST_BATCHSIZE]
 
-    generate_function = model.generate if hasattr(model, "generate") else model.module.generate
+            batch_start = time.perf_counter()
 
-    for seq, real_perm in (pbar:=tqdm(
-        zip(test_seqs, test_perms), desc="Testing", total=len(test_perms), disable=not should_talk
-    )):
-        gen_perm = tuple(generate_function(seq, accelerator, force_valid=True))
+            if DECODING == "beam":
+                gen_perms, scores = unwrapped_model.generate_beam(seqs, accelerator)
+            elif DECODING == "parallel":
+                gen_perms, batch_iterations = unwrapped_model.generate_parallel(seqs, accelerator, force_valid=True)
+                iterations.extend(batch_iterations)
+            else:
+                gen_perms = decoder.generate_batch(seqs, accelerator, force_valid=True)
 
-        results.append((real_perm == gen_perm).all())
-        pbar.set_description(f"Cur accuracy: {sum(results) / len(results)}")
+            batch_times.append(time.perf_counter() - batch_start)
+
+            batch_results = (real_perms == gen_perms).all(axis=1)
+            results.extend(batch_results)
+            correct += batch_results.sum()
+
+            pbar.update(len(seqs))
+            pbar.set_description(f"Cur accuracy: {correct / len(results)}")
 
     if should_talk:
         print(f"Accuracy: {sum(results) / len(results)}")
 
+        if COMPILE_MODEL and len(batch_times) > 1:
+            print(f"First batch (including compiling): {batch_times[0]}s")
+            print(f"Steady state time per batch: {np.mean(batch_times[1:])}s")
+        else:
+            print(f"Time per batch: {np.mean(batch_times)}s")
+
+        if iterations:
+            # greedy decoding always takes MAX_GROUP_SIZE passes
+            passes, counts = np.unique(iterations, return_counts=True)
+
+            print(f"Mean parallel decoding passes: {np.mean(iterations)} (out of {MAX_GROUP_SIZE})")
+            print("Passes needed:", ", ".join(f"{p}: {c}" for p, c in zip(passes, counts)))
+
     # write results to a file that r can read
     if should_talk:
         print("Writing results to file")
@@ -8,7 +8,10 @@ from utilities import *
 from dataloading import *
 from tqdm.auto import tqdm
 from transformer import *
-from accelerate import Accelerator, load_checkpoint_and_dispatch
+from checkpointing import CheckpointManager
+from evaluation import Evaluator
+from accelerate import Accelerator
+import time
 import os
 
 def train(
@@ -39,7 +42,8 @@ def train(
     file_path = f"{save_directory}/model.safetensors"
     
     if os.path.isfile(file_path):
-        model = load_checkpoint_and_dispatch(model, file_path)
+        # a probed model only has some of the blocks, plus its probe
+        model = load_weights(model, file_path, strict=stop_block is None)
 
     # Define the loss function
     criterion = nn.CrossEntropyLoss()
@@ -68,11 +72,40 @@ def train(
     ) = load_data(dataset_class, question)
 
     # set up accelerator
-    model, optimizer, train_dataloader, scheduler = accelerator.prepare(
-        model, optimizer, train_dataloader, scheduler
-    )
+    # streamed and generated data is already split between the processes
+    streaming = isinstance(train_dataloader.dataset, IterableDataset)
+
+    # accelerate doesn't pass the epoch on to our own samplers
+    train_sampler = getattr(train_dataloader, "batch_sampler", None)
+
+    if not hasattr(train_sampler, "set_epoch"):
+        train_sampler = None
+
+    if streaming:
+        model, optimizer, scheduler = accelerator.prepare(
+            model, optimizer, scheduler
+        )
+    else:
+        model, optimizer, train_dataloader, scheduler = accelerator.prepare(
+            model, optimizer, train_dataloader, scheduler
+        )
+
+    # the evaluator splits the validation rows between the processes itself
+    evaluator = Evaluator(accelerator, val_dataloader.dataset, val_seqs)
+
+    # only the training steps are compiled, evaluation stays eager
+    # bucketed batches change shape, so let torch work out which dimensions are dynamic
+    if COMPILE_MODEL:
+        train_model = torch.compile(model, dynamic=None if BUCKETED_BATCHES else False)
+    else:
+        train_model = model
 
-    val_dataloader = accelerator.prepare(val_dataloader)
+    # carry on from the last checkpoint if there is one
+    checkpoints = CheckpointManager(accelerator, f"{save_directory}{suffix}/checkpoints")
+    progress = checkpoints.load(model, optimizer, scheduler) if RESUME else None
+
+    if progress is not None and accelerator.is_local_main_process:
+        print(f"Resuming from epoch {progress['epoch'] + 1}, step {progress['global_step']}")
 
     if accelerator.is_local_main_process:
         print("Training...")
@@ -115,7 +148,13 @@ def train(
                 "window_count": WINDOW_COUNT,
                 "partitioned_windows": PARTITIONED_WINDOWS,
                 "masked": MASKED_MODEL,
-                "legacy_architecture": LEGACY_ARCHITECTURE
+                "legacy_architecture": LEGACY_ARCHITECTURE,
+                "compile_model": COMPILE_MODEL,
+                "log_every_steps": LOG_EVERY_STEPS,
+                "eval_mode": EVAL_MODE,
+                "eval_subset_size": EVAL_SUBSET_SIZE if EVAL_MODE == "subset" else None,
+                "eval_every_steps": EVAL_EVERY_STEPS,
+                "online_data": ONLINE_DATA
             },
             settings=wandb.Settings(start_method="fork"),
             resume="allow",
@@ -126,23 +165,65 @@ def train(
     # cur_patience = 0
     # best_loss = float("inf")
 
-    last_train_loss = None
-    last_val_loss = None
+    if progress is None:
+        progress = {
+            "epoch": 0,
+            "batches_done": 0,
+            "global_step": 0,
+            "epoch_totals": [],
+            "last_train_loss": None,
+            "last_val_loss": None
+        }
+
+    last_train_loss = progress["last_train_loss"]
+    last_val_loss = progress["last_val_loss"]
+
+    global_step = progress["global_step"]
+
+    # the model gets compiled again when a run is resumed, so this is timed in every run
+    compile_time = None
+    compile_time_logged = False
 
     # training loop
-    for epoch in range(num_epochs):
+    for epoch in range(progress["epoch"], num_epochs):
         model.train()  # Set the model to training mode
 
-        total_train_loss = 0.0
-        total_train_accuracy = 0.0
+        # running (loss, accuracy) totals, kept on the device
+        # so nothing has to wait for the gpu until they get logged
+        epoch_totals = torch.zeros(2, device=accelerator.device)
+        interval_totals = torch.zeros(2, device=accelerator.device)
+
         num_batches = 0
+        interval_batches = 0
+        timed_batches = 0
+        interval_start = time.perf_counter()
 
         if accelerator.is_local_main_process:
             print("Training...")
+
+        if streaming:
+            train_dataloader.dataset.set_epoch(epoch)
         
-        for inputs, targets in tqdm(train_dataloader, disable=not accelerator.is_local_main_process):
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+
+        epoch_dataloader = train_dataloader
+
+        # skip what we'd already done in this epoch before stopping
+        if epoch == progress["epoch"] and progress["batches_done"]:
+            epoch_dataloader = accelerator.skip_first_batches(train_dataloader, progress["batches_done"])
+            # every process has its own totals, a different number of processes just uses the first one's
+            totals = progress["epoch_totals"]
+            totals = totals[accelerator.process_index] if accelerator.process_index < len(totals) else totals[0]
+            epoch_totals += torch.tensor(totals, device=accelerator.device)
+            num_batches = progress["batches_done"]
+
+        for inputs, targets in tqdm(epoch_dataloader, disable=not accelerator.is_local_main_process):
+            if streaming:
+                inputs, targets = inputs.to(accelerator.device), targets.to(accelerator.device)
+
             optimizer.zero_grad()  # Zero the gradients
-            outputs = model(inputs)  # Forward pass
+            outputs = train_model(inputs)  # Forward pass
 
             outputs, targets = reshape_outputs(outputs, targets)
 
@@ -151,66 +232,97 @@ def train(
             optimizer.step()  # Update weights
 
             # stat track
-            total_train_loss += loss.item()
-            accuracy = calculate_accuracy(outputs, targets)
-            total_train_accuracy += accuracy
-            num_batches += 1
+            step_stats = torch.stack((loss.detach(), calculate_accuracy(outputs, targets)))
+            epoch_totals += step_stats
+            interval_totals += step_stats
 
-        average_train_accuracy = total_train_accuracy / num_batches
-        train_loss = total_train_loss / num_batches
+            num_batches += 1
+            interval_batches += 1
+            timed_batches += 1
+            global_step += 1
+
+            # the first compiled step includes the compiling, so time it on its own
+            if COMPILE_MODEL and compile_time is None:
+                loss.item() # wait for it to finish
+                compile_time = time.perf_counter() - interval_start
+
+                timed_batches = 0
+                interval_start = time.perf_counter()
+
+            if global_step % LOG_EVERY_STEPS == 0:
+                # the only time the loop waits for the stats
+                interval_loss, interval_accuracy = (accelerator.reduce(interval_totals, "mean") / interval_batches).tolist()
+                step_time = (time.perf_counter() - interval_start) / max(1, timed_batches)
+
+                if accelerator.is_local_main_process:
+                    wandb.log({
+                        "step_training_loss": interval_loss,
+                        "step_training_accuracy": interval_accuracy,
+                        "step_time": step_time,
+                        "samples_per_second": BATCHSIZE / step_time
+                    }, step=global_step)
+
+                interval_totals.zero_()
+                interval_batches = 0
+                timed_batches = 0
+                interval_start = time.perf_counter()
+
+            if EVAL_EVERY_STEPS is not None and global_step % EVAL_EVERY_STEPS == 0:
+                step_val_loss, step_val_accuracy = evaluator.evaluate(model)
+
+                if accelerator.is_local_main_process:
+                    wandb.log({
+                        "step_validation_loss": step_val_loss,
+                        "step_validation_accuracy": step_val_accuracy
+                    }, step=global_step)
+
+            if checkpoints.should_save(global_step):
+                checkpoints.save(model, optimizer, scheduler, {
+                    "epoch": epoch,
+                    "batches_done": num_batches,
+                    "global_step": global_step,
+                    "epoch_totals": accelerator.gather(epoch_totals).view(accelerator.num_processes, -1).tolist(),
+                    "last_train_loss": last_train_loss,
+                    "last_val_loss": last_val_loss
+                })
+
+        train_loss, average_train_accuracy = (accelerator.reduce(epoch_totals, "mean") / num_batches).tolist()
 
         # Calculate and print accuracy after each epoch
-        with torch.no_grad():
-            model.eval()  # Set the model to evaluation mode
-
-            # calculate validation stats
-            total_accuracy = 0.0
-            total_loss = 0.0
-
-            num_batches = 0
-
-            if accelerator.is_local_main_process:
-                print("Evaluating...")
-
-            for inputs, targets in tqdm(val_dataloader, disable=not accelerator.is_local_main_process):
-                outputs = model(inputs)
-
-                all_outputs, all_targets = reshape_outputs(*accelerator.gather_for_metrics((outputs, targets)))
-
-                outputs, targets = reshape_outputs(outputs, targets)
-
-                # calculate the val accuracy
-                accuracy = calculate_accuracy(outputs, targets)
-                total_accuracy += accuracy
-
-                # Calculate the val loss
-                loss = criterion(all_outputs, all_targets)
-                total_loss += loss.item()
-                num_batches += 1
-
-            average_accuracy = total_accuracy / num_batches
-            val_loss = total_loss / num_batches
-
-            metrics = {
-                "validation_accuracy": average_accuracy,
-                "loss": val_loss,
-                "training_accuracy": average_train_accuracy,
-                "training_loss": train_loss
-            }
+        if accelerator.is_local_main_process:
+            print("Evaluating...")
+
+        val_loss, average_accuracy = evaluator.evaluate(model)
+
+        metrics = {
+            "validation_accuracy": average_accuracy,
+            "loss": val_loss,
+            "training_accuracy": average_train_accuracy,
+            "training_loss": train_loss,
+            "epoch": epoch
+        }
+
+        # logged with the first epoch this run finishes, whichever epoch that is
+        if compile_time is not None and not compile_time_logged:
+            metrics["compile_time"] = compile_time
+            compile_time_logged = True
+
+        # to show how fast we're plateauing
+        if epoch > 0:
+            metrics["delta_train_loss"] = train_loss - last_train_loss
+            metrics["delta_val_loss"] = val_loss - last_val_loss
+        
+        last_train_loss = train_loss
+        last_val_loss = val_loss
 
-            # to show how fast we're plateauing
-            if epoch > 0:
-                metrics["delta_train_loss"] = train_loss - last_train_loss
-                metrics["delta_val_loss"] = val_loss - last_val_loss
-            
-            last_train_loss = train_loss
-            last_val_loss = val_loss
+        if accelerator.is_local_main_process:
+            print(f"Epoch {epoch + 1}, Train loss {train_loss} Train Accuracy {average_train_accuracy} Validation Accuracy: {average_accuracy}, Val loss: {val_loss}")
 
-            if accelerator.is_local_main_process:
-                print(f"Epoch {epoch + 1}, Train loss {train_loss} Train Accuracy {average_train_accuracy} Validation Accuracy: {average_accuracy}, Val loss: {val_loss}")
+            if "compile_time" in metrics:
+                print(f"Compile time: {metrics['compile_time']}s")
 
-                # log metrics to wandb
-                wandb.log(metrics)
+            # log metrics to wandb
+            wandb.log(metrics, step=global_step)
 
         # early stopping
         # if train_loss < best_loss:
@@ -220,19 +332,29 @@ def train(
         # else:
         #     cur_patience += 1
             
-        # always save the model
-        accelerator.wait_for_everyone()
-        accelerator.save_model(model, f"{save_directory}{suffix}")
-        
         # save embedding pictures so we can make gifs later
         # this is broken since we added accelerate
         # TODO: FIX this later
         if accelerator.is_local_main_process:
-            save_embedding_pictures(model, accelerator)
+            save_embedding_pictures(model, accelerator, epoch)
 
         # if cur_patience == patience:
         #     print("Early stopping activated")
         #     break
 
         # learning rate scheduling
-        scheduler.step(train_loss)
\ No newline at end of file
+        scheduler.step(train_loss)
+
+        # always save the model
+        # this is a full checkpoint too, so an interrupted run starts again from the next epoch
+        checkpoints.save(model, optimizer, scheduler, {
+            "epoch": epoch + 1,
+            "batches_done": 0,
+            "global_step": global_step,
+            "epoch_totals": [],
+            "last_train_loss": last_train_loss,
+            "last_val_loss": last_val_loss
+        }, export_to=f"{save_directory}{suffix}")
+
+    # make sure the last checkpoint gets written
+    checkpoints.wait()
\ No newline at end of file
@@ -3,7 +3,7 @@ from torch import cuda
 import torch.nn as nn
 from torch.nn import functional as F
 from config import *
-from utilities import convert_tokens_to_perm, token_type
+from utilities import convert_tokens_to_perm
 from accelerate import Accelerator
 import numpy as np
 
@@ -14,6 +14,160 @@ import numpy as np
 
 assert n_embed % n_head == 0
 
+class KVCache:
+    """
+        Keys and values of the tokens seen so far, used for incremental decoding.
+        The buffers cover the whole context and are indexed by absolute position,
+        so the block mask can be used as is and nothing gets reallocated.
+    """
+
+    def __init__(self):
+        # one (keys, values) pair per attention head
+        self.buffers = {}
+
+        # which positions have been written to
+        self.filled = None
+
+        # which keys each row can attend to, only used for bucketed batches (see Transformer.forward)
+        self.key_mask = None
+
+        # where the next tokens go
+        self.length = 0
+
+    def get(self, head, shape, like):
+        if head not in self.buffers:
+            self.buffers[head] = (
+                torch.zeros(shape, dtype=like.dtype, device=like.device),
+                torch.zeros(shape, dtype=like.dtype, device=like.device)
+            )
+
+        return self.buffers[head]
+
+    def fill(self, positions):
+        if self.filled is None:
+            self.filled = torch.zeros(CONTEXT_LENGTH, dtype=bool, device=positions.device)
+
+        self.filled[positions] = True
+
+    def mask_keys(self, positions, key_mask):
+        # remembers which of the new keys can be attended to, and returns it for every position
+        if self.key_mask is None:
+            self.key_mask = torch.ones(len(key_mask), CONTEXT_LENGTH, dtype=bool, device=key_mask.device)
+
+        self.key_mask[:, positions] = key_mask
+
+        return self.key_mask
+
+    def store(self, head, k, v, positions):
+        # writes the new keys and values, and returns everything the new tokens can attend to
+        keys, values = self.get(head, (*k.shape[:-2], CONTEXT_LENGTH, k.shape[-1]), k)
+        keys[..., positions, :] = k
+        values[..., positions, :] = v
+
+        return keys, values
+
+    def scores(self, q, keys):
+        return q @ keys.transpose(-2, -1)
+
+    def aggregate(self, wei, values):
+        return wei @ values
+
+class BeamCache(KVCache):
+    """
+        A KVCache for beam search, made from the cache of the prefix (the input and the start token).
+        The prefix is only stored once per sequence and every beam of that sequence attends to it.
+        Each beam only has its own copy of the positions after the prefix,
+        so reordering the beams only moves those.
+        The beams of a sequence have to be next to each other in the batch.
+    """
+
+    def __init__(self, cache, beam_width):
+        super().__init__()
+
+        self.prefix = cache.buffers
+        self.prefix_length = int(cache.length)
+        self.beam_width = beam_width
+
+        self.filled = cache.filled
+        self.length = cache.length
+
+        # every beam has the same input as its sequence
+        if cache.key_mask is not None:
+            self.key_mask = cache.key_mask.repeat_interleave(beam_width, dim=0)
+
+    def get(self, head, shape, like):
+        # just the positions after the prefix, one row per beam
+        return super().get(head, (*shape[:-2], CONTEXT_LENGTH - self.prefix_length, shape[-1]), like)
+
+    def store(self, head, k, v, positions):
+        keys, values = self.get(head, (*k.shape[:-2], CONTEXT_LENGTH, k.shape[-1]), k)
+        keys[..., positions - self.prefix_length, :] = k
+        values[..., positions - self.prefix_length, :] = v
+
+        prefix_keys, prefix_values = self.prefix[head]
+        P = self.prefix_length
+
+        return (prefix_keys[..., :P, :], keys), (prefix_values[..., :P, :], values)
+
+    def per_sequence(self, x, shared):
+        """
+            x @ shared, where x has a row per beam and shared has a row per sequence.
+            The beams of each sequence are stacked as extra rows of one matrix,
+            so shared never gets copied for every beam.
+        """
+        K, T = self.beam_width, x.shape[-2]
+
+        # (B*K, ..., T, X) -> (B, ..., K*T, X)
+        stacked = x.unflatten(0, (-1, K)).movedim(1, -3).flatten(-3, -2)
+        out = stacked @ shared
+
+        # and back to (B*K, ..., T, Y)
+        return out.unflatten(-2, (K, T)).movedim(-3, 1).flatten(0, 1)
+
+    def scores(self, q, keys):
+        prefix_keys, keys = keys
+
+        # the columns are still in position order, so the usual mask works
+        return torch.cat((self.per_sequence(q, prefix_keys.transpose(-2, -1)), q @ keys.transpose(-2, -1)), dim=-1)
+
+    def aggregate(self, wei, values):
+        prefix_values, values = values
+        P = self.prefix_length
+
+        return self.per_sequence(wei[..., :P], prefix_values) + wei[..., P:] @ values
+
+    def select(self, indices):
+        # reorders the beams, only the positions that have been decoded so far need moving
+        decoded = int(self.length) - self.prefix_length
+
+        for keys, values in self.buffers.values():
+            keys[..., :decoded, :] = keys[indices, ..., :decoded, :]
+            values[..., :decoded, :] = values[indices, ..., :decoded, :]
+
+# the tokens each row of a batch is still allowed to generate when forcing valid permutations
+# starts as every permutation token, tokens get cleared as they are used
+def allowed_tokens(batch_size, device):
+    allowed = torch.zeros(batch_size, vocab_size, dtype=bool, device=device)
+    allowed[:, num_trans:num_normal] = True
+
+    return allowed
+
+# create a mask that only effects the permutation tokens
+def block_mask():
+    if not REVERSE_PROBLEM:
+        allowed_length = INPUT_LENGTH
+    else:
+        allowed_length = MAX_GROUP_SIZE
+    
+    blocked_length = CONTEXT_LENGTH-allowed_length
+    
+    A = torch.ones(allowed_length, allowed_length)
+    B = torch.zeros(allowed_length, blocked_length)
+    C = torch.ones(blocked_length, allowed_length)
+    D = torch.tril(torch.ones(blocked_length, blocked_length))
+        
+    return torch.cat((torch.cat((A, B), dim=1), torch.cat((C, D), dim=1)), dim=0)
+
 class Head(nn.Module):
     def __init__(self, head_size):
         super().__init__()
@@ -22,39 +176,39 @@ class Head(nn.Module):
         self.value = nn.Linear(n_embed, head_size, bias=False)
         self.dropout = nn.Dropout(dropout)
 
-        # create a mask that only effects the permutation tokens
-        if not REVERSE_PROBLEM:
-            allowed_length = INPUT_LENGTH
-        else:
-            allowed_length = MAX_GROUP_SIZE
-        
-        blocked_length = CONTEXT_LENGTH-allowed_length
-        
-        A = torch.ones(allowed_length, allowed_length)
-        B = torch.zeros(allowed_length, blocked_length)
-        C = torch.ones(blocked_length, allowed_length)
-        D = torch.tril(torch.ones(blocked_length, blocked_length))
-            
-        E = torch.cat((torch.cat((A, B), dim=1), torch.cat((C, D), dim=1)), dim=0)  
-
-        self.register_buffer('tril', E)
+        self.register_buffer('tril', block_mask())
 
         # this is just a place to attach a hook
         self.attention_hook = nn.Identity()
 
         self.sanity_hook = nn.Identity()
 
-    def forward(self, x):
+    def forward(self, x, cache=None, positions=None, key_mask=None):
         B, T, C = x.shape
 
         k = self.key(x) # (B, T, C)
         q = self.query(x) # (B, T, C)
+        v = self.value(x) # (B, T, C)
 
-        # compute attention scores ("affinities")
-        wei = q @ k.transpose(-2, -1) * C**-0.5 # (B, T, C) @ (B, C, T) -> (B, T, T)
+        if cache is not None:
+            # attend to everything seen so far, not just the new tokens
+            k, v = cache.store(self, k, v, positions) # (B, CONTEXT_LENGTH, C)
+
+            wei = cache.scores(q, k) * C**-0.5 # (B, T, CONTEXT_LENGTH)
+        else:
+            # compute attention scores ("affinities")
+            wei = q @ k.transpose(-2, -1) * C**-0.5 # (B, T, C) @ (B, C, T) -> (B, T, T)
+
+        if cache is not None:
+            # the rows of the mask for the new tokens, minus anything not written yet
+            wei = wei.masked_fill((self.tril[positions] == 0) | ~cache.filled, float('-inf'))
+        elif MASKED_MODEL:
+            mask = self.tril[:T, :T] if positions is None else self.tril[positions][:, positions]
+            wei = wei.masked_fill(mask == 0, float('-inf')) # (B, T, T)
 
-        if MASKED_MODEL:
-            wei = wei.masked_fill(self.tril[:T, :T] == 0, float('-inf')) # (B, T, T)
+        if key_mask is not None:
+            # the padding at the end of bucketed words
+            wei = wei.masked_fill(~key_mask.unsqueeze(1), float('-inf'))
 
         wei = self.sanity_hook(wei)
 
@@ -64,8 +218,7 @@ class Head(nn.Module):
         wei = self.attention_hook(wei)
 
         # perform the weighted aggregation of the values
-        v = self.value(x) # (B, T, C)
-        out = wei @ v # (B, T, T) @ (B, T, C) -> (B, T, C)
+        out = wei @ v if cache is None else cache.aggregate(wei, v) # (B, T, T) @ (B, T, C) -> (B, T, C)
         return out
     
 class MultiHeadAttention(nn.Module):
@@ -75,13 +228,144 @@ class MultiHeadAttention(nn.Module):
         self.proj = nn.Linear(n_embed, n_embed)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # split the one projection saved by FusedMultiHeadAttention back into separate heads
+        if f"{prefix}qkv.weight" in state_dict:
+            num_heads = len(self.heads)
+            weights = state_dict.pop(f"{prefix}qkv.weight").chunk(3 * num_heads, dim=0)
+
+            for index, name in enumerate(["query", "key", "value"]):
+                for head in range(num_heads):
+                    state_dict[f"{prefix}heads.{head}.{name}.weight"] = weights[index * num_heads + head]
+
+            # the fused version doesn't save the masks, they're always the same anyway
+            for head, module in enumerate(self.heads):
+                for name, buffer in module.named_buffers(recurse=False):
+                    state_dict.setdefault(f"{prefix}heads.{head}.{name}", buffer)
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, cache=None, positions=None, key_mask=None):
         return self.dropout(
             self.proj(
-                torch.cat([h(x) for h in self.heads], dim=-1)
+                torch.cat([h(x, cache, positions, key_mask) for h in self.heads], dim=-1)
             )
         )
 
+class FusedMultiHeadAttention(nn.Module):
+    """
+        Same maths as MultiHeadAttention, but all the heads are done at once
+        with one projection and F.scaled_dot_product_attention.
+        Checkpoints are saved and loaded with separate heads, like MultiHeadAttention,
+        so they work with everything that reads the old layout.
+        If a hook is attached to attention_hook or sanity_hook the attention
+        is done by hand so the hooks see it, with shape (B, n_head, T, T).
+    """
+
+    def __init__(self, num_heads, head_size):
+        super().__init__()
+        self.num_heads = num_heads
+        self.head_size = head_size
+
+        # queries, then keys, then values, each one split up into heads
+        self.qkv = nn.Linear(n_embed, 3 * num_heads * head_size, bias=False)
+        self.proj = nn.Linear(n_embed, n_embed)
+        self.dropout = nn.Dropout(dropout)
+
+        # checkpoints are saved with separate heads
+        self._register_state_dict_hook(FusedMultiHeadAttention._save_separate_heads)
+
+        # the mask never changes, so don't bother saving it
+        self.register_buffer('tril', block_mask().bool(), persistent=False)
+
+        # this is just a place to attach a hook
+        self.attention_hook = nn.Identity()
+
+        self.sanity_hook = nn.Identity()
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # turn the weights of separate heads into one projection
+        if f"{prefix}heads.0.query.weight" in state_dict:
+            weights = {"query": [], "key": [], "value": []}
+
+            for head in range(self.num_heads):
+                for name in weights:
+                    weights[name].append(state_dict.pop(f"{prefix}heads.{head}.{name}.weight"))
+
+                state_dict.pop(f"{prefix}heads.{head}.tril", None)
+
+            state_dict[f"{prefix}qkv.weight"] = torch.cat(
+                weights["query"] + weights["key"] + weights["value"], dim=0
+            )
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _save_separate_heads(self, destination, prefix, local_metadata):
+        # split the projection up so the checkpoint has the same keys as MultiHeadAttention
+        # this runs after qkv has saved its weight
+        weights = destination.pop(f"{prefix}qkv.weight").chunk(3 * self.num_heads, dim=0)
+
+        for head in range(self.num_heads):
+            for index, name in enumerate(["query", "key", "value"]):
+                # copied, safetensors won't save tensors that share memory
+                destination[f"{prefix}heads.{head}.{name}.weight"] = weights[index * self.num_heads + head].clone()
+
+            # separate heads save their masks too
+            destination[f"{prefix}heads.{head}.tril"] = self.tril.float()
+
+    def forward(self, x, cache=None, positions=None, key_mask=None):
+        B, T, C = x.shape
+
+        # (B, T, 3*C) -> 3 lots of (B, n_head, T, head_size)
+        q, k, v = self.qkv(x).view(B, T, 3, self.num_heads, self.head_size).permute(2, 0, 3, 1, 4)
+
+        if cache is not None:
+            k, v = cache.store(self, k, v, positions) # (B, n_head, CONTEXT_LENGTH, head_size)
+
+            mask = self.tril[positions] & cache.filled
+        elif MASKED_MODEL:
+            mask = self.tril[:T, :T] if positions is None else self.tril[positions][:, positions]
+        else:
+            mask = None
+
+        if key_mask is not None:
+            # the padding at the end of bucketed words, (B, 1, T, T)
+            mask = mask & key_mask[:, None, None, :]
+
+        # a beam cache splits the keys and values up, so it can't go through the fused kernel
+        if self.attention_hook._forward_hooks or self.sanity_hook._forward_hooks or isinstance(cache, BeamCache):
+            wei = (q @ k.transpose(-2, -1) if cache is None else cache.scores(q, k)) * C**-0.5 # (B, n_head, T, T)
+
+            if mask is not None:
+                wei = wei.masked_fill(~mask, float('-inf'))
+
+            wei = self.sanity_hook(wei)
+
+            wei = F.softmax(wei, dim=-1)
+            wei = F.dropout(wei, dropout, self.training)
+
+            wei = self.attention_hook(wei)
+
+            out = wei @ v if cache is None else cache.aggregate(wei, v)
+        else:
+            out = F.scaled_dot_product_attention(
+                q, k, v,
+                attn_mask=mask,
+                dropout_p=dropout if self.training else 0,
+                scale=C**-0.5
+            )
+
+        # put the heads back side by side
+        out = out.transpose(1, 2).reshape(B, T, C)
+
+        return self.dropout(self.proj(out))
+
+# pick which attention the model is built with
+if FUSED_ATTENTION:
+    Attention = FusedMultiHeadAttention
+else:
+    Attention = MultiHeadAttention
+
 class FeedForward(nn.Module):
     def __init__(self, n_embed):
         super().__init__()
@@ -102,16 +386,16 @@ class Block(nn.Module):
         super().__init__()
         head_size = n_embed // n_head
 
-        self.sa = MultiHeadAttention(n_head, head_size)
+        self.sa = Attention(n_head, head_size)
         self.ffwd = FeedForward(n_embed)
 
         self.ln1 = nn.LayerNorm(n_embed)
         self.ln2 = nn.LayerNorm(n_embed)
 
-    def forward(self, x):
+    def forward(self, x, cache=None, positions=None, key_mask=None):
         # residuals
         # don't use += as this breaks things
-        x = x + self.sa(self.ln1(x))
+        x = x + self.sa(self.ln1(x), cache, positions, key_mask)
         x = x + self.ffwd(self.ln2(x))
         return x
 
@@ -125,7 +409,7 @@ class Transformer(nn.Module):
         self.embed_hook = nn.Identity()
 
         if LEGACY_ARCHITECTURE:
-            self.sa_heads = MultiHeadAttention(n_head, n_embed//n_head)
+            self.sa_heads = Attention(n_head, n_embed//n_head)
         
         self.blocks = [Block(n_embed, n_head) for _ in range(n_blocks)]
         self.blocks.append(nn.LayerNorm(n_embed))
@@ -141,20 +425,58 @@ class Transformer(nn.Module):
         # and we don't want to apply that twice
         self.softmax = nn.Softmax(dim=1)
 
-    def forward(self, idx):
+    def forward(self, idx, cache=None):
+        """
+            If a KVCache is given, idx only needs to hold the tokens
+            that come after the ones already in the cache.
+        """
         B, T = idx.shape
 
+        if cache is not None:
+            if not MASKED_MODEL:
+                raise Exception("Caching only works for masked models")
+
+            # written this way so cache.length can also be a tensor when tracing (see export.py)
+            positions = cache.length + torch.arange(T, device=idx.device)
+            cache.fill(positions)
+        elif BUCKETED_BATCHES and MASKED_MODEL and not REVERSE_PROBLEM and T < CONTEXT_LENGTH:
+            # the input has been cut down to its real length (see trim_collate)
+            # everything after the input keeps its usual positions
+            positions = torch.cat((
+                torch.arange(T - (CONTEXT_LENGTH - INPUT_LENGTH), device=idx.device),
+                torch.arange(INPUT_LENGTH, CONTEXT_LENGTH, device=idx.device)
+            ))
+        else:
+            positions = torch.arange(T, device=idx.device)
+
+        # with bucketed batches the zeroes in the input are padding, so nothing attends to them
+        # that way a row gets the same output however long the other rows in its batch are
+        # the first token is always kept so an empty word still has something to attend to
+        if BUCKETED_BATCHES and MASKED_MODEL and not REVERSE_PROBLEM:
+            key_mask = (idx != 0) | (positions >= INPUT_LENGTH) | (positions == 0) # (B, T)
+
+            if cache is not None:
+                key_mask = cache.mask_keys(positions, key_mask) # (B, CONTEXT_LENGTH)
+        else:
+            key_mask = None
+
         # idx and targets are both (B, T) tensor of integers
         tok_emb = self.token_embedding_table(idx) #(B, T, C)
-        pos_emb = self.position_embedding(torch.arange(T, device=idx.device)) #(T, C)
+        pos_emb = self.position_embedding(positions) #(T, C)
 
         x = tok_emb + pos_emb #(B, T, C)
         x = self.embed_hook(x)
 
         if LEGACY_ARCHITECTURE:
-            x = self.sa_heads(x) # apply one head of self attention (B, T, C)
+            x = self.sa_heads(x, cache, positions, key_mask) # apply one head of self attention (B, T, C)
         
-        x = self.blocks(x) # apply a bunch of blocks (sa + feedforward) (B, T, C)
+        # apply a bunch of blocks (sa + feedforward) (B, T, C)
+        # nn.Sequential can't pass the cache, positions and mask along
+        for block in self.blocks:
+            x = block(x, cache, positions, key_mask) if isinstance(block, Block) else block(x)
+
+        if cache is not None:
+            cache.length = cache.length + T
 
         logits = self.lm_head(x) #(B, T, vocab_size)
 
@@ -170,6 +492,34 @@ class Transformer(nn.Module):
 
         return logits
     
+    def prefill_input(self, sequences, dev):
+        """
+            Puts the input sequences through the network and returns the cache.
+            The input can't see the permutation tokens,
+            so its keys and values only need to be worked out once.
+        """
+        sequences = torch.tensor(np.asarray(sequences, dtype=np.int64), device=dev)
+        B, L = sequences.shape
+
+        input_tensor = torch.ones(B, INPUT_LENGTH, dtype=int, device=dev)
+        input_tensor[:, :L] = sequences
+
+        if BUCKETED_BATCHES:
+            # same as in training, the zeroes get moved to the end and cut off
+            order = torch.argsort((input_tensor == 0).int(), dim=1, stable=True)
+            input_tensor = input_tensor.gather(1, order)
+
+            input_length = max(1, (input_tensor != 0).sum(dim=1).max().item())
+            input_tensor = input_tensor[:, :input_length]
+
+        cache = KVCache()
+        self(input_tensor, cache)
+
+        # anything cut off the input is just never filled in
+        cache.length = INPUT_LENGTH
+
+        return cache
+
     def generate(self, sequence, accelerator, force_valid=False, debug=False, stop_at=float("inf")):
         """
             Generates a permutation for a sequence.
@@ -177,58 +527,201 @@ class Transformer(nn.Module):
             guaranteed to be a valid permutation, if not a correct one.
         """
 
+        # handle old models
+        if not MASKED_MODEL:
+            return self.old_generate(sequence, force_valid, debug, stop_at)
+
+        return self.generate_batch([sequence], accelerator, force_valid, debug, stop_at)[0]
+
+    @torch.no_grad()
+    def generate_batch(self, sequences, accelerator, force_valid=False, debug=False, stop_at=float("inf")):
+        """
+            Generates permutations for a batch of sequences in lockstep.
+            Returns a (B, MAX_GROUP_SIZE) array with one permutation per row.
+            force_valid works the same as in generate, separately for every row.
+        """
+
         dev = accelerator.device
 
         # handle old models
         if not MASKED_MODEL:
-            return self.old_generate(sequence, force_valid, debug, stop_at)
+            return np.array([
+                self.old_generate(sequence, force_valid, debug, stop_at) for sequence in sequences
+            ])
 
         self.eval()
-        
-        # create an initial input to the network
-        input_tensor = torch.ones(INPUT_LENGTH + 1, dtype=int).to(dev)
-        input_tensor[:len(sequence)] = torch.tensor(sequence, dtype=int).to(dev)
-        input_tensor[-1] = START_PREDICTION_TOKEN
-        
-        # actually generate the permutation
-        permutation = []
 
-        # print("Model device:", self.token_embedding_table.weight.get_device())
-        # print("Input tensor device:", input_tensor.get_device())
+        B = len(sequences)
+
+        permutations = torch.empty(B, MAX_GROUP_SIZE, dtype=int, device=dev)
+        rows = torch.arange(B, device=dev)
+
+        allowed = allowed_tokens(B, dev)
+
+        cache = self.prefill_input(sequences, dev)
+        new_tokens = torch.full((B, 1), START_PREDICTION_TOKEN, dtype=int, device=dev)
 
         # do the autoregression
         for x in range(MAX_GROUP_SIZE):
-            # get the logits
-            logits = self(input_tensor.unsqueeze(0))[:, -1, :]
+            if force_valid and x == MAX_GROUP_SIZE - 1:
+                # there's only one token left, we don't need the network to find it
+                chosen = allowed.int().argmax(dim=-1)
+            else:
+                logits = self(new_tokens, cache)[:, -1, :]
 
-            if debug:
-                print(f"Step {x} logits: {logits}")
-            
-            # get the most likely token
-            chosen = None
+                if debug:
+                    print(f"Step {x} logits: {logits}")
 
-            if not force_valid:
-                chosen = logits.argmax().item()
-            else:
-                for token in logits.argsort(descending=True)[0]:
-                    if token not in permutation and token_type(token) == "permutation":
-                        chosen = token
-                        break
-            
-            if chosen == None:
-                raise Exception("No possible token found - this shouldn't be possible")
-            
-            # append it to the permutation
-            permutation.append(chosen)
-            
-            # add it to the input tensor
-            input_tensor = torch.cat((input_tensor, torch.tensor([chosen]).to(dev)))
+                if force_valid:
+                    logits = logits.masked_fill(~allowed, float('-inf'))
+
+                chosen = logits.argmax(dim=-1)
+
+            permutations[:, x] = chosen
+            allowed[rows, chosen] = False
+
+            # only the new token needs to go through the network next time
+            new_tokens = chosen.unsqueeze(1)
 
             # allows for early stopping
             if x >= stop_at:
                 break
-        
-        return np.array(convert_tokens_to_perm(permutation))
+
+        return permutations[:, :x+1].cpu().numpy() - num_trans
+
+    @torch.no_grad()
+    def generate_parallel(self, sequences, accelerator, force_valid=False, initial_guess=None):
+        """
+            Jacobi decoding: guesses every permutation token at once, then
+            predicts all of them in one forward pass given the guess, and repeats
+            until the prediction stops changing.
+            After pass k the first k tokens are guaranteed to be the greedy ones,
+            so this never takes more than MAX_GROUP_SIZE passes, and a fixed point
+            is exactly the output of generate_batch.
+            Returns the permutations and the number of passes each row needed.
+        """
+
+        if not MASKED_MODEL or REVERSE_PROBLEM:
+            raise Exception("Parallel decoding only works for masked models")
+
+        dev = accelerator.device
+
+        self.eval()
+
+        B = len(sequences)
+
+        # the input never changes, so put it in the cache once
+        cache = self.prefill_input(sequences, dev)
+
+        # by default guess the identity, which is a decent guess for our data
+        if initial_guess is None:
+            guess = torch.arange(num_trans, num_trans + MAX_GROUP_SIZE, device=dev).repeat(B, 1)
+        else:
+            guess = torch.tensor(np.asarray(initial_guess, dtype=np.int64), device=dev) + num_trans
+
+        start_tokens = torch.full((B, 1), START_PREDICTION_TOKEN, dtype=int, device=dev)
+        permutation_tokens = allowed_tokens(1, dev)
+
+        iterations = torch.full((B,), MAX_GROUP_SIZE, dtype=int, device=dev)
+        converged = torch.zeros(B, dtype=bool, device=dev)
+
+        for iteration in range(1, MAX_GROUP_SIZE + 1):
+            logits = self(torch.cat((start_tokens, guess[:, :-1]), dim=1), cache) # (B, MAX_GROUP_SIZE, vocab_size)
+
+            # overwrite the same slots next time
+            cache.length = INPUT_LENGTH
+
+            if force_valid:
+                # every position can use whatever the guess hasn't used before it
+                used = F.one_hot(guess, vocab_size).cumsum(dim=1) - F.one_hot(guess, vocab_size)
+                allowed = permutation_tokens & (used == 0)
+
+                logits = logits.masked_fill(~allowed, float('-inf'))
+
+            new_guess = logits.argmax(dim=-1)
+
+            # rows that didn't change have reached their fixed point
+            settled = (new_guess == guess).all(dim=1) & ~converged
+            iterations[settled] = iteration
+            converged |= settled
+
+            guess = new_guess
+
+            if converged.all():
+                break
+
+        return guess.cpu().numpy() - num_trans, iterations.cpu().numpy()
+
+    @torch.no_grad()
+    def generate_beam(self, sequences, accelerator, beam_width=BEAM_WIDTH, length=MAX_GROUP_SIZE, tie_break=BEAM_TIE_BREAK):
+        """
+            Beam search, keeping the beam_width most likely valid permutations for every sequence.
+            All the beams of all the sequences are one batch, and the beams of a sequence
+            share the cached keys and values of its input (see BeamCache).
+            tie_break can be "stable" (ties go to the better beam, then the smaller token)
+            or "fast" (whatever topk does).
+            Returns the best permutation of every row and its log probability.
+        """
+
+        if not MASKED_MODEL or REVERSE_PROBLEM:
+            raise Exception("Beam search only works for masked models")
+
+        if tie_break not in ["stable", "fast"]:
+            raise Exception("Invalid tie break")
+
+        dev = accelerator.device
+
+        self.eval()
+
+        B = len(sequences)
+        K = beam_width
+
+        # run the input once, all the beams of a sequence share it
+        cache = self.prefill_input(sequences, dev)
+        start_tokens = torch.full((B, 1), START_PREDICTION_TOKEN, dtype=int, device=dev)
+        logits = self(start_tokens, cache)[:, -1, :]
+
+        rows = torch.arange(B, device=dev)
+        beams = torch.arange(B * K, device=dev)
+
+        cache = BeamCache(cache, K)
+        logits = logits.repeat_interleave(K, dim=0) # (B*K, vocab_size)
+
+        # all beams start out identical, so only the first one counts at the start
+        scores = torch.full((B, K), float('-inf'), device=dev)
+        scores[:, 0] = 0
+
+        allowed = allowed_tokens(B * K, dev)
+        permutations = torch.empty(B * K, 0, dtype=int, device=dev)
+
+        for x in range(length):
+            log_probs = F.log_softmax(logits, dim=-1).masked_fill(~allowed, float('-inf'))
+
+            # score of every (beam, token) pair for each row
+            candidates = (scores.unsqueeze(-1) + log_probs.view(B, K, vocab_size)).view(B, K * vocab_size)
+
+            if tie_break == "stable":
+                scores, best = candidates.sort(dim=-1, descending=True, stable=True)
+                scores, best = scores[:, :K], best[:, :K]
+            else:
+                scores, best = candidates.topk(K, dim=-1)
+
+            # which beam each new beam came from, and the token it added
+            source = (best // vocab_size + rows.unsqueeze(1) * K).view(-1)
+            chosen = (best % vocab_size).view(-1)
+
+            permutations = torch.cat((permutations[source], chosen.unsqueeze(1)), dim=1)
+            allowed = allowed[source]
+            allowed[beams, chosen] = False
+
+            if x < length - 1:
+                cache.select(source)
+                logits = self(chosen.unsqueeze(1), cache)[:, -1, :]
+
+        # beams are sorted, so the first one is the best
+        best_permutations = permutations.view(B, K, -1)[:, 0]
+
+        return best_permutations.cpu().numpy() - num_trans, scores[:, 0].cpu().numpy()
 
     def old_generate(self, sequence, force_valid=False, debug=False, stop_at=float("inf")):
 
@@ -252,30 +745,29 @@ class Transformer(nn.Module):
         # actually generate the permutation
         permutation = []
 
+        allowed = allowed_tokens(1, dev)
+
         # do the autoregression
         for x in range(MAX_GROUP_SIZE):
-            # get the logits
-            logits = self(input_tensor.unsqueeze(0))
+            if force_valid and x == MAX_GROUP_SIZE - 1:
+                # there's only one token left, we don't need the network to find it
+                chosen = allowed.int().argmax().item()
+            else:
+                # get the logits
+                logits = self(input_tensor.unsqueeze(0))
 
-            if debug:
-                print(f"Step {x} logits: {logits}")
-            
-            # get the most likely token
-            chosen = None
+                if debug:
+                    print(f"Step {x} logits: {logits}")
 
-            if not force_valid:
+                if force_valid:
+                    logits = logits.masked_fill(~allowed, float('-inf'))
+
+                # get the most likely token
                 chosen = logits.argmax().item()
-            else:
-                for token in logits.argsort(descending=True)[0]:
-                    if token not in permutation and token_type(token) == "permutation":
-                        chosen = token
-                        break
-            
-            if chosen == None:
-                raise Exception("No possible token found - this shouldn't be possible")
             
             # append it to the permutation
             permutation.append(chosen)
+            allowed[0, chosen] = False
             
             # add it to the input tensor
             input_tensor[AR_index + x] = chosen
@@ -284,4 +776,117 @@ class Transformer(nn.Module):
             if x >= stop_at:
                 break
         
-        return np.array(convert_tokens_to_perm(permutation))
\ No newline at end of file
+        return np.array(convert_tokens_to_perm(permutation))
+
+class CachedStep(nn.Module):
+    """
+        Runs the model on some tokens with the cache passed in as plain tensors,
+        so that it can be traced or compiled (see export.py and StaticDecoder).
+        keys and values are (n_blocks, B, n_head, CONTEXT_LENGTH, head_size)
+        and get written to in place, everything before length is treated as filled.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, tokens, length, keys, values):
+        cache = KVCache()
+        layers = [block.sa for block in self.model.blocks if isinstance(block, Block)]
+
+        for layer, attention in enumerate(layers):
+            if isinstance(attention, MultiHeadAttention):
+                for head, module in enumerate(attention.heads):
+                    cache.buffers[module] = (keys[layer][:, head], values[layer][:, head])
+            else:
+                cache.buffers[attention] = (keys[layer], values[layer])
+
+        cache.length = length
+        cache.filled = torch.arange(CONTEXT_LENGTH, device=tokens.device) < length
+
+        logits = self.model(tokens, cache)[:, -1, :]
+
+        return logits, keys, values
+
+# the tensors CachedStep keeps its cache in
+def empty_cache(batch_size, device="cpu"):
+    shape = (n_blocks, batch_size, n_head, CONTEXT_LENGTH, n_embed // n_head)
+
+    return torch.zeros(shape, device=device), torch.zeros(shape, device=device)
+
+class StaticDecoder:
+    """
+        Greedy decoding where every step has exactly the same shapes,
+        so the step can be compiled once and reused.
+        The cache is kept in fixed buffers, the position is a tensor,
+        and batches smaller than batch_size are padded out.
+    """
+
+    def __init__(self, model, batch_size=TEST_BATCHSIZE, compile=COMPILE_MODEL):
+        if not MASKED_MODEL or REVERSE_PROBLEM or LEGACY_ARCHITECTURE:
+            raise Exception("Static decoding only works for masked models with the current architecture")
+
+        if BUCKETED_BATCHES:
+            raise Exception("Static decoding can't trim the input, turn off BUCKETED_BATCHES")
+
+        self.model = model
+        self.batch_size = batch_size
+
+        self.step = CachedStep(model)
+
+        if compile:
+            self.step = torch.compile(self.step, dynamic=False)
+
+        self.keys = None
+        self.values = None
+        self.positions = None
+
+    @torch.no_grad()
+    def generate_batch(self, sequences, accelerator, force_valid=False):
+        """
+            Same as Transformer.generate_batch.
+        """
+        dev = accelerator.device
+        B = self.batch_size
+
+        self.model.eval()
+
+        sequences = torch.tensor(np.asarray(sequences, dtype=np.int64), device=dev)
+        rows, L = sequences.shape
+
+        if rows > B:
+            raise Exception(f"Can't generate more than {B} sequences at once")
+
+        # allocated once, the filled part always gets overwritten
+        if self.keys is None:
+            self.keys, self.values = empty_cache(B, dev)
+            self.positions = torch.arange(CONTEXT_LENGTH, device=dev)
+
+        input_tensor = torch.ones(B, INPUT_LENGTH, dtype=int, device=dev)
+        input_tensor[:rows, :L] = sequences
+
+        self.step(input_tensor, self.positions[0], self.keys, self.values)
+
+        permutations = torch.empty(B, MAX_GROUP_SIZE, dtype=int, device=dev)
+        batch_rows = torch.arange(B, device=dev)
+
+        allowed = allowed_tokens(B, dev)
+        new_tokens = torch.full((B, 1), START_PREDICTION_TOKEN, dtype=int, device=dev)
+
+        for x in range(MAX_GROUP_SIZE):
+            if force_valid and x == MAX_GROUP_SIZE - 1:
+                chosen = allowed.int().argmax(dim=-1)
+            else:
+                logits, _, _ = self.step(new_tokens, self.positions[INPUT_LENGTH + x], self.keys, self.values)
+
+                if force_valid:
+                    logits = logits.masked_fill(~allowed, float('-inf'))
+
+                chosen = logits.argmax(dim=-1)
+
+            permutations[:, x] = chosen
+            allowed[batch_rows, chosen] = False
+
+            new_tokens = chosen.unsqueeze(1)
+
+        return permutations[:rows].cpu().numpy() - num_trans
\ No newline at end of file
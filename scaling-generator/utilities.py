@@ -2,10 +2,19 @@ from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.decomposition import TruncatedSVD
 from torch import argmax
 from accelerate import Accelerator
+from safetensors.torch import load_file
 import numpy as np
 from config import *
 import os
 
+# loads a saved model into an existing one
+# goes through load_state_dict so old checkpoints can be converted on the way in
+# any missing or unexpected weights are an error unless strict is turned off
+def load_weights(model, file_path, strict=True):
+    model.load_state_dict(load_file(file_path), strict=strict)
+
+    return model
+
 # moves all the zeroes to the end
 class ZeroShifter(BaseEstimator, TransformerMixin):
     def __init__(self):
@@ -14,21 +23,19 @@ class ZeroShifter(BaseEstimator, TransformerMixin):
     def fit(self, X, y=None):
         return self
 
-    def transform(self, X):
-      X = np.copy(X)
-
-      for pos, sequence in enumerate(X):
-        new_sequence = [0 for x in range(len(X[0]))]
+    def transform(self, X, chunk_size=2**16):
+      X = np.asarray(X)
+      shifted = np.empty_like(X)
 
-        counter = 0
-        for word in sequence:
-          if word != 0:
-            new_sequence[counter] = word
-            counter += 1
+      # done a chunk of rows at a time so the sort indices stay small
+      for start in range(0, len(X), chunk_size):
+        chunk = X[start:start+chunk_size]
 
-        X[pos] = new_sequence
+        # a stable sort on "is it zero" keeps everything else in order
+        order = np.argsort(chunk == 0, axis=1, kind="stable")
+        shifted[start:start+chunk_size] = np.take_along_axis(chunk, order, axis=1)
 
-      return X
+      return shifted
 
 # reduce the dimensionality of the dataset without losing information
 # this makes the training process faster and the resulting model is just as good
@@ -78,11 +85,13 @@ def calculate_accuracy(output, target):
     return (argmax(output, dim=1) == target).float().mean()
 
 # takes a permutation and converts it to tokens
+# binary shards can be stored as uint8 (see convert_data.py), which would overflow
+# so everything is made a python int before it gets shifted
 def convert_perm_to_tokens(perm):
-    return [int(char + num_trans) for char in perm]
+    return [int(char) + num_trans for char in perm]
 
 def convert_tokens_to_perm(tokens):
-    return [int(token - num_trans) for token in tokens]
+    return [int(token) - num_trans for token in tokens]
 
 # takes a token and tells you what type it is
 def token_type(token):
@@ -93,7 +102,21 @@ def token_type(token):
     return "special"
 
 # saves the embedding similarity matrices so we can make a gif later
-def save_embedding_pictures(model, accelerator):
+# each picture is a cosine similarity matrix of the embeddings
+# they're appended as raw float32 to embedding_pictures/<type>/<model>.bin
+# and <model>.index gets a line saying where each epoch's picture starts
+# so saving never has to read the old pictures back in
+def embedding_picture_files(embedding_type, modelname=MODELNAME):
+    directory = f"./embedding_pictures/{embedding_type}"
+
+    return f"{directory}/{modelname}.bin", f"{directory}/{modelname}.index"
+
+def cosine_similarity(embedding):
+    embedding = embedding / np.linalg.norm(embedding, axis=1, keepdims=True)
+
+    return embedding @ embedding.T
+
+def save_embedding_pictures(model, accelerator, epoch=None):
     posindices, tokindices = (
         torch.arange(block_size).to(accelerator.device),
         torch.arange(vocab_size).to(accelerator.device)
@@ -109,29 +132,57 @@ def save_embedding_pictures(model, accelerator):
 
     for embedding_type, embedding in types:
         # generate the picture
-        embedding = embedding.detach().cpu().numpy()
+        embedding = embedding.detach().float().cpu().numpy()
+        picture = cosine_similarity(embedding).astype(np.float32)
+
+        data_file, index_file = embedding_picture_files(embedding_type)
+        os.makedirs(os.path.dirname(data_file), exist_ok=True)
+
+        # the data goes first, so a picture is only ever indexed once it's all there
+        with open(data_file, "ab") as file:
+            offset = file.tell()
+            file.write(picture.tobytes())
+
+        with open(index_file, "a") as file:
+            file.write(f"{epoch},{offset},{len(picture)}\n")
+
+def load_embedding_pictures(embedding_type, modelname=MODELNAME):
+    """
+        Reads the pictures saved by save_embedding_pictures, for making gifs.
+        Returns the epochs and a matching list of (x, x) pictures,
+        which are memory mapped so only the ones you look at get read.
+        Old runs saved one picture per epoch in a .npy file instead, a run that
+        carried on after the switch has some in each, so both get read.
+        If an epoch was saved more than once (eg. after resuming) the last one is used.
+    """
+    data_file, index_file = embedding_picture_files(embedding_type, modelname)
+    old_file = data_file.replace(".bin", ".npy")
+
+    if not os.path.isfile(index_file) and not os.path.isfile(old_file):
+        raise Exception(f"Couldn't find any {embedding_type} embedding pictures for {modelname}")
+
+    pictures = {}
+
+    if os.path.isfile(old_file):
+        pictures.update(enumerate(np.load(old_file, mmap_mode="r")))
 
-        similarity = []
+    # pictures saved without an epoch go after the old ones
+    unnumbered = len(pictures)
 
-        for x in embedding:
-            row = []
-            for y in embedding:
-                row.append(np.dot(x, y)/(np.linalg.norm(x)*np.linalg.norm(y)))
-            similarity.append(row)
+    if os.path.isfile(index_file):
+        data = np.memmap(data_file, dtype=np.float32, mode="r")
 
-        # save the picture
-        # this is a fancy way to get the array to have shape (1, x, x)
-        pictures = np.array(similarity).transpose()[:,:,np.newaxis].transpose()
+        with open(index_file, "r") as file:
+            for position, line in enumerate(file):
+                epoch, offset, size = line.strip().split(",")
+                key = unnumbered + position if epoch == "None" else int(epoch)
 
-        filename = f"./embedding_pictures/{embedding_type}/{MODELNAME}.npy"
+                start, size = int(offset) // data.itemsize, int(size)
+                pictures[key] = data[start:start + size*size].reshape(size, size)
 
-        if os.path.isfile(filename):
-            with open(filename, "rb") as file:
-                old_pictures = np.load(file)
-                pictures = np.concatenate((old_pictures, pictures))
+    epochs = sorted(pictures)
 
-        with open(filename, "wb") as file:
-            np.save(file, pictures)
+    return epochs, [pictures[epoch] for epoch in epochs]
 
 def reshape_outputs(outputs, targets):
     B, T, C = outputs.shape